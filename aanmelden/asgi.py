@@ -9,10 +9,11 @@ https://docs.djangoproject.com/en/3.0/howto/deployment/asgi/
 
 import os
 
+from asgiref.sync import sync_to_async
 from django.core.asgi import get_asgi_application
 from socketio import ASGIApp
 
-from aanmelden.sockets import sio
+from aanmelden.sockets import sio, bus
 
 # Only used in debug/devel mode
 static_files = {
@@ -21,4 +22,23 @@ static_files = {
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "aanmelden.settings")
 
-application = ASGIApp(sio, get_asgi_application(), static_files=static_files)
+django_application = get_asgi_application()
+
+# Needs the apps to be loaded first
+# pylint: disable-next=wrong-import-position
+from aanmelden.src.utils import provider_metadata
+
+
+async def startup():
+    await bus.start()
+    # Have the IdP metadata ready before the first request needs it
+    await sync_to_async(provider_metadata.start, thread_sensitive=False)()
+
+
+application = ASGIApp(
+    sio,
+    django_application,
+    static_files=static_files,
+    on_startup=startup,
+    on_shutdown=bus.stop,
+)
@@ -72,6 +72,12 @@ DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
         "NAME": os.path.join(BASE_DIR, "db.sqlite3"),
+        # Take the write lock when a transaction starts, so registrations are
+        # admitted one at a time (SQLite ignores select_for_update)
+        "OPTIONS": {"transaction_mode": "IMMEDIATE"},
+        # The concurrency tests need a database file, shared cache in-memory
+        # databases fail on lock contention instead of waiting for it
+        "TEST": {"NAME": os.path.join(BASE_DIR, "test_db.sqlite3")},
     }
 }
 DEFAULT_AUTO_FIELD = "django.db.models.AutoField"
@@ -128,6 +134,8 @@ IDP_INTROSPECTION_URL = "https://leden.djoamersfoort.nl/o/introspect/"
 OPENID_CONFIGURATION = (
     "https://leden.djoamersfoort.nl/o/.well-known/openid-configuration/"
 )
+# The OpenID configuration and signing keys are kept here between restarts
+OPENID_CACHE_FILE = os.path.join(BASE_DIR, "openid-cache.json")
 # Corvee is allowed to call the 'presence' API
 API_CLIENT_WHITELIST = ["xxxxxxx"]
 
@@ -143,3 +151,7 @@ SLOT_LEVELS = {
     6: 2,
     7: 2,
 }
+
+# Presences older than this many days are moved to the archive by the
+# archive_presences command
+PRESENCE_ARCHIVE_DAYS = 365
@@ -1,3 +1,157 @@
+import asyncio
+import glob
+import logging
+import os
+import socket
+import threading
+
 import socketio
+from socketio.async_pubsub_manager import AsyncPubSubManager
+from asgiref.sync import sync_to_async
+
+logger = logging.getLogger(__name__)
+
+
+class UnixSocketManager(AsyncPubSubManager):
+    """
+    Shares emits between the server processes on one host. Every process binds
+    a Unix datagram socket in a common directory and publishes its messages to
+    the sockets of all other processes. Sockets of processes that are gone are
+    removed when a publish to them is refused.
+    """
+
+    name = "unixsocket"
+    max_size = 1 << 20
+
+    def __init__(self, path, channel="socketio", **kwargs):
+        super().__init__(channel=channel, **kwargs)
+        self.path = path
+        self.address = os.path.join(path, f"{channel}-{self.host_id}.sock")
+        self.sock = None
+
+    def _socket(self, bind=False):
+        if self.sock is None:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.sock.setblocking(False)
+        if bind and not self.sock.getsockname():
+            os.makedirs(self.path, exist_ok=True)
+            self.sock.bind(self.address)
+        return self.sock
+
+    def peers(self):
+        pattern = os.path.join(self.path, f"{self.channel}-*.sock")
+        return [peer for peer in glob.glob(pattern) if peer != self.address]
+
+    async def _publish(self, data):
+        message = self.json.dumps(data).encode()
+        sock = self._socket()
+        for peer in self.peers():
+            try:
+                sock.sendto(message, peer)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # The process is gone
+                try:
+                    os.unlink(peer)
+                except FileNotFoundError:
+                    pass
+            except OSError:
+                # Including a full receive buffer, the message is dropped
+                self._get_logger().exception("Cannot publish to %s", peer)
+
+    async def _listen(self):
+        sock = self._socket(bind=True)
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                yield await loop.sock_recv(sock, self.max_size)
+        finally:
+            sock.close()
+            self.sock = None
+            try:
+                os.unlink(self.address)
+            except FileNotFoundError:
+                pass
+
+
+# With more than one server process, uvicorn is started with the directory
+# the processes use to reach each other
+PEER_DIR = os.environ.get("SOCKETIO_PEER_DIR")
+
+sio = socketio.AsyncServer(
+    async_mode="asgi",
+    cors_allowed_origins="*",
+    client_manager=UnixSocketManager(PEER_DIR) if PEER_DIR else None,
+)
+
+
+class BroadcastBus:
+    """
+    Queues update events from the (sync) request threads and emits them on the
+    server's own event loop. Events are coalesced: every event is emitted at
+    most once per window, no matter how often it was queued.
+
+    The changes passed along with an event are lists, which are concatenated
+    until the event is emitted. If set, build(event, changes) is called (in a
+    worker thread) to turn them into a list of (room, payload) to emit.
+    """
+
+    def __init__(self, server, window=0.5, build=None):
+        self.server = server
+        self.window = window
+        self.build = build
+        self.loop = None
+        self.pending = {}
+        self.tasks = set()
+        self.lock = threading.Lock()
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+
+    async def stop(self):
+        self.loop = None
+
+    def notify(self, event, **changes):
+        loop = self.loop
+        if loop is None:
+            # Not running in the ASGI server (tests, management commands)
+            return
+
+        with self.lock:
+            schedule = not self.pending
+            pending = self.pending.setdefault(event, {})
+            for name, items in changes.items():
+                pending.setdefault(name, []).extend(items)
+
+        if schedule:
+            loop.call_soon_threadsafe(loop.call_later, self.window, self.flush)
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+
+        loop = asyncio.get_running_loop()
+        for event, changes in sorted(pending.items()):
+            task = loop.create_task(self.emit(event, changes))
+            # Keep a reference until the emit is done
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def emit(self, event, changes):
+        if not self.build:
+            await self.server.emit(event)
+            return
+
+        try:
+            messages = await sync_to_async(self.build, thread_sensitive=False)(
+                event, changes
+            )
+        except Exception:  # pylint: disable=broad-exception-caught
+            logger.exception("Building the %s payload failed", event)
+            # Let the clients fetch the whole page instead
+            messages = [(None, {"reload": True})]
+
+        for room, payload in messages:
+            await self.server.emit(event, payload, to=room)
+
 
-sio = socketio.AsyncServer(async_mode="asgi", cors_allowed_origins="*")
+bus = BroadcastBus(sio)
@@ -2,7 +2,16 @@ from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
 from django.contrib.auth import get_user_model
 
-from aanmelden.src.models import Presence, SpecialDate, MacAddress, UserInfo, Slot
+from aanmelden.src.models import (
+    ArchivedPresence,
+    Presence,
+    SpecialDate,
+    MacAddress,
+    UserInfo,
+    Slot,
+    RecurringException,
+    RecurringPresence,
+)
 
 
 @admin.register(Presence)
@@ -11,6 +20,23 @@ class PresenceAdmin(admin.ModelAdmin):
     list_filter = ("user",)
 
 
+@admin.register(ArchivedPresence)
+class ArchivedPresenceAdmin(admin.ModelAdmin):
+    date_hierarchy = "date"
+    list_filter = ("user",)
+
+
+class RecurringExceptionInline(admin.TabularInline):
+    model = RecurringException
+    extra = 0
+
+
+@admin.register(RecurringPresence)
+class RecurringPresenceAdmin(admin.ModelAdmin):
+    list_display = ("user", "name", "pod", "start", "until", "expanded_until")
+    inlines = (RecurringExceptionInline,)
+
+
 # Define an inline admin descriptor for User model
 # which acts a bit like a singleton
 class UserInfoInline(admin.StackedInline):
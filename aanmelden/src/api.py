@@ -3,21 +3,38 @@ from datetime import datetime
 from json import loads
 
 from django.conf import settings
-from django.db.models import Value, F
+from django.db import IntegrityError, transaction
+from django.db.models import Value, F, Q
 from django.db.models.functions import Concat
 from django.http import JsonResponse, HttpResponseBadRequest, HttpResponse
+from django.utils.cache import get_conditional_response
 from django.utils.dateparse import parse_date
 from django.utils.decorators import method_decorator
+from django.utils.http import quote_etag
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import condition
 from django.views.generic import View
 
+from aanmelden.src import metrics, updates
+from aanmelden.src.freeslots import free_slots_cache
+from aanmelden.src.macindex import mac_index
 from aanmelden.src.mixins import (
     ClientCredentialsRequiredMixin,
     SlotContextMixin,
     AuthenticatedMixin,
 )
 from aanmelden.src.models import DjoUser
-from aanmelden.src.models import Presence, MacAddress, Slot, DAY_NUMBERS
+from aanmelden.src.models import (
+    Attendance,
+    Occupancy,
+    Presence,
+    RecurringException,
+    RecurringPresence,
+    Slot,
+    StateVersion,
+    DAY_NUMBERS,
+)
+from aanmelden.src.signals import delete_presences, slots_changed
 from aanmelden.src.utils import (
     register,
     register_future,
@@ -31,47 +48,129 @@ from aanmelden.src.utils import (
 )
 
 
+def free_etag(request, *args, **kwargs):  # pylint: disable=unused-argument
+    """
+    The slot list only changes with the state version, or when the slots
+    move on to the next week. Reading the version is a single query, so an
+    unchanged list is answered with a 304 without building it.
+    """
+    return f"{StateVersion.current()}-{date.today().isoformat()}"
+
+
+def slots_etag(request, *args, **kwargs):
+    # The list is personalized
+    return f"{free_etag(request)}-{request.user.pk}"
+
+
 class FreeV2(View):
     def get(self, request, *args, **kwargs):
-        slots = Slot.get_enabled_slots()
-        for slot in slots:
-            slot.pop("tutors", None)
-            slot.pop("is_registered", None)
-
-        return JsonResponse(slots, safe=False)
+        # Like the condition decorator, but the version is read only once for
+        # both the ETag and the cached body
+        etag = free_etag(request)
+        response = get_conditional_response(request, etag=quote_etag(etag))
+        if response is None:
+            # The body is already encoded, JsonResponse would encode it again
+            # pylint: disable-next=http-response-with-content-type-json
+            response = HttpResponse(
+                free_slots_cache.get_body(etag), content_type="application/json"
+            )
+        response.headers["ETag"] = quote_etag(etag)
+        return response
+
+
+def parse_mac_event(line):
+    """Returns (None, mac) for a join event, or (error, None)"""
+    parts = line.split(" ")
+    if len(parts) != 3:
+        return "malformed", None
+    if parts[0] != "join":
+        return "ignored", None
+    if parts[1].count(":") < 5:
+        return "malformed_mac", None
+    return None, parts[1].lower()
+
+
+def mark_seen_by_mac(macs) -> dict:
+    """
+    Mark the users of the given MAC addresses as seen today, in a fixed
+    number of queries. Returns the result per MAC address.
+
+    Unknown MAC addresses and users that were already seen today are answered
+    from the MAC index, without queries.
+    """
+    if not macs:
+        return {}
+
+    owners = mac_index.get_owners(macs)
+    seen = {user for user in owners.values() if mac_index.is_seen(user)}
+    pending = set(owners.values()) - seen
+    hits = sum(1 for mac in macs if mac not in owners or owners[mac] in seen)
+    metrics.increment("mac_index_hits", hits)
+    metrics.increment("mac_index_misses", len(macs) - hits)
+
+    registered = set(seen)
+    if pending:
+        presences = list(Presence.objects.filter(date=date.today(), user__in=pending))
+        registered.update(presence.user_id for presence in presences)
+        changed = [p for p in presences if not (p.seen and p.seen_by == "mac")]
+
+        if changed:
+            newly_seen = [(p.user_id, p.date) for p in changed if not p.seen]
+            with transaction.atomic():
+                Presence.objects.filter(pk__in=[p.pk for p in changed]).update(
+                    seen=True, seen_by="mac"
+                )
+                Attendance.adjust_many(newly_seen, 1)
+                # A bulk update sends no signals
+                for presence in changed:
+                    presence.seen = True
+                    presence.seen_by = "mac"
+                    updates.presence_changed(presence)
+                StateVersion.bump()
+        mac_index.mark_seen(presence.user_id for presence in presences)
+
+    results = {}
+    for mac in macs:
+        if mac not in owners:
+            results[mac] = "unknown_mac"
+        elif owners[mac] in registered:
+            results[mac] = "seen"
+        else:
+            results[mac] = "not_registered"
+    return results
 
 
 @method_decorator(csrf_exempt, name="dispatch")
 class MacEvent(View):
-    def post(self, request, *args, **kwargs):
-        body = request.body.decode("utf8")
-        parts = body.split(" ")
-        if len(parts) != 3:
-            return HttpResponseBadRequest("Malformed body received")
+    """
+    Takes one event ("join <mac> <x>") or many, one per line. A single event
+    gets a plain text response, many get a JSON list with a result per line.
+    """
+
+    messages = {
+        "malformed": "Malformed body received",
+        "malformed_mac": "Malformed mac address received",
+        "ignored": "Ignored",
+        "unknown_mac": "Unknown MAC address",
+    }
 
-        event_type = parts[0]
-        mac = parts[1]
+    def post(self, request, *args, **kwargs):
+        events = []
+        for line in request:
+            line = line.decode("utf8").strip()
+            if line:
+                events.append(parse_mac_event(line))
 
-        if event_type != "join":
-            return HttpResponse("Ignored")
-        if mac.count(":") < 5:
-            return HttpResponseBadRequest("Malformed mac address received")
+        seen = mark_seen_by_mac({mac for _, mac in events if mac})
+        results = [error or seen[mac] for error, mac in events]
 
-        # Get user that owns this MAC address
-        try:
-            mac_address = MacAddress.objects.get(mac=mac.lower())
-        except MacAddress.DoesNotExist:
-            return HttpResponse("Unknown MAC address")
-
-        try:
-            presence = Presence.objects.get(date=date.today(), user=mac_address.user)
-            presence.seen = True
-            presence.seen_by = "mac"
-            presence.save()
-        except Presence.DoesNotExist:
-            pass
+        if len(results) > 1:
+            return JsonResponse({"results": results})
 
-        return HttpResponse("OK")
+        result = results[0] if results else "malformed"
+        if result in ("malformed", "malformed_mac"):
+            return HttpResponseBadRequest(self.messages[result])
+        return HttpResponse(self.messages.get(result, "OK"))
 
 
 @method_decorator(csrf_exempt, name="dispatch")
@@ -97,11 +196,95 @@ class ArePresentV2(ClientCredentialsRequiredMixin, SlotContextMixin, View):
 
     # Return a list of present user ids (IDP backend ids)
     def post(self, request, *args, **kwargs):
-        presences = Presence.objects.filter(
+        present_members = Presence.objects.filter(
             date=self.slot.date, pod=self.slot.pod, seen=True
+        ).values_list("user__username", flat=True)
+        return JsonResponse({"members": list(present_members)})
+
+
+@method_decorator(csrf_exempt, name="dispatch")
+class PresenceMatrix(ClientCredentialsRequiredMixin, View):
+    """
+    Which users are present in which slots, for many of both at once:
+    {"users": ["idp-1", ...], "slots": [{"day": "fri", "pod": "e"}, ...]}.
+    Without "users", only the present users are listed per slot. Slots that
+    do not exist are returned as null.
+    """
+
+    whitelisted_client_ids = settings.API_CLIENT_WHITELIST
+
+    @staticmethod
+    def parse_body(body):
+        """Returns (users or None, [(day, pod), ...]), raises ValueError"""
+        try:
+            body = loads(body.decode("utf8"))
+            users = body.get("users")
+            keys = [(slot["day"], slot["pod"]) for slot in body["slots"]]
+        except (KeyError, TypeError, AttributeError) as e:
+            raise ValueError("Invalid body") from e
+        if users is not None and not isinstance(users, list):
+            raise ValueError("Invalid body")
+        values = [value for key in keys for value in key] + (users or [])
+        if not all(isinstance(value, str) for value in values):
+            raise ValueError("Invalid body")
+        return users, keys
+
+    @staticmethod
+    def get_present(slots, users):
+        """The usernames of the present users per slot, in one query"""
+        present = {key: set() for key in slots}
+        if not slots:
+            return present
+
+        dates = {(slot.date, slot.pod): key for key, slot in slots.items()}
+        presences = Presence.objects.filter(
+            date__in={on_date for on_date, _ in dates},
+            pod__in={pod for _, pod in dates},
+            seen=True,
         )
-        present_members = [presence.user.username for presence in presences]
-        return JsonResponse({"members": present_members})
+        if users is not None:
+            presences = presences.filter(user__username__in=users)
+        for on_date, pod, username in presences.values_list(
+            "date", "pod", "user__username"
+        ):
+            if (on_date, pod) in dates:
+                present[dates[(on_date, pod)]].add(username)
+        return present
+
+    def post(self, request, *args, **kwargs):
+        try:
+            users, keys = self.parse_body(request.body)
+        except ValueError:
+            return HttpResponseBadRequest("Invalid body")
+
+        match = Q(pk__in=[])
+        for day, pod in keys:
+            match |= Q(name=day, pod=pod)
+        slots = {(slot.name, slot.pod): slot for slot in Slot.objects.filter(match)}
+        present = self.get_present(slots, users)
+
+        matrix = {}
+        for key in keys:
+            if key not in slots:
+                matrix[f"{key[0]}-{key[1]}"] = None
+                continue
+            matrix[f"{key[0]}-{key[1]}"] = {
+                "date": slots[key].date,
+                "present": {
+                    username: username in present[key]
+                    for username in (
+                        users if users is not None else sorted(present[key])
+                    )
+                },
+            }
+        return JsonResponse({"slots": matrix})
+
+
+class Metrics(ClientCredentialsRequiredMixin, View):
+    whitelisted_client_ids = settings.API_CLIENT_WHITELIST
+
+    def get(self, request, *args, **kwargs):
+        return JsonResponse(metrics.snapshot())
 
 
 class PresentSinceDate(View):
@@ -110,12 +293,10 @@ class PresentSinceDate(View):
         from_date = date(
             year=kwargs.get("year"), month=kwargs.get("month"), day=kwargs.get("day")
         )
-        count = Presence.objects.filter(
-            user__username=userid, date__gte=from_date, seen=True
-        ).count()
-        return JsonResponse({"count": count})
+        return JsonResponse({"count": Attendance.count_since(userid, from_date)})
 
 
+@method_decorator(condition(etag_func=slots_etag), name="get")
 class Slots(AuthenticatedMixin, View):
     def get(self, request):
         slots = Slot.get_enabled_slots(request.user)
@@ -125,7 +306,7 @@ class Slots(AuthenticatedMixin, View):
         for slot in slots:
             slot["presence"] = list(
                 Presence.objects.filter(
-                    date=slot["date"], pod=slot["pod"], user__is_superuser=False
+                    date=slot["date"], pod=slot["pod"], is_tutor=False
                 )
                 .values("id", "seen")
                 .annotate(
@@ -216,37 +397,202 @@ class DeRegister(AuthenticatedMixin, SlotContextMixin, View):
         return JsonResponse({"error": None})
 
 
+def get_weekday_slots() -> dict:
+    """The (first) slot of every weekday"""
+    slots = {}
+    for slot in Slot.objects.order_by("pk"):
+        slots.setdefault(DAY_NUMBERS[slot.name], slot)
+    return slots
+
+
+def parse_future_dates(values, slots, results) -> dict:
+    """
+    Map the given ISO dates to the pod of the slot on their weekday. Dates
+    that cannot be used get their outcome in results.
+    """
+    dates = {}
+    for value in values:
+        try:
+            day = parse_date(value)
+        except (TypeError, ValueError):
+            day = None
+        if day is None:
+            results[str(value)] = "invalid_date"
+        elif day < date.today():
+            results[day.isoformat()] = "past"
+        elif day.weekday() not in slots:
+            results[day.isoformat()] = "no_slot"
+        else:
+            dates[day] = slots[day.weekday()].pod
+    return dates
+
+
+def register_future_many(user, dates, results):
+    """
+    register_future() for many dates, in a fixed number of queries. Returns
+    whether any presence was added.
+    """
+    # Concurrent registrations of the user wait for this one, so all rows
+    # that are new after the bulk create are ours
+    DjoUser.lock(user.pk)
+    existing = {
+        pk: (day, pod)
+        for pk, day, pod in Presence.objects.filter(
+            user=user, date__in=dates
+        ).values_list("pk", "date", "pod")
+    }
+    registered = set(existing.values())
+    # Unique, dates is a dict
+    keys = [key for key in dates.items() if key not in registered]
+    if keys:
+        Presence.objects.bulk_create(
+            [
+                Presence(user=user, date=day, pod=pod, is_tutor=user.is_superuser)
+                for day, pod in keys
+            ],
+            ignore_conflicts=True,
+        )
+
+    # Only count the rows that were actually inserted, conflicting ones are
+    # skipped by the bulk create
+    created = [
+        presence
+        for presence in Presence.objects.filter(
+            user=user, date__in=[day for day, _ in keys]
+        )
+        if presence.pk not in existing and (presence.date, presence.pod) in keys
+    ]
+    added = {presence.date for presence in created}
+    for day in dates:
+        results[day.isoformat()] = "added" if day in added else "already_registered"
+    if not created:
+        return False
+
+    # A bulk create sends no signals
+    Occupancy.adjust_many(
+        [(presence.date, presence.pod) for presence in created], user.is_superuser, 1
+    )
+    for presence in created:
+        presence.user = user
+    updates.presences_added(created)
+    return True
+
+
+def deregister_future_many(user, dates, results):
+    """
+    deregister_future() for many dates, in a fixed number of queries. Returns
+    whether any presence was removed.
+    """
+    presences = [
+        presence
+        for presence in Presence.objects.filter(user=user, date__in=dates)
+        if dates[presence.date] == presence.pod
+    ]
+    # Also skips the dates the rules did not register for yet
+    exceptions = RecurringPresence.skipped_by(user, list(dates.items()))
+    RecurringException.objects.bulk_create(exceptions, ignore_conflicts=True)
+    removed = {presence.date for presence in presences}
+    removed.update(exception.date for exception in exceptions)
+    for day in dates:
+        results[day.isoformat()] = "removed" if day in removed else "not_registered"
+
+    if presences:
+        delete_presences(presences)
+    if exceptions:
+        # A bulk create sends no signals
+        slots_changed()
+    return bool(removed)
+
+
 @method_decorator(csrf_exempt, name="dispatch")
 class FutureUpdate(AuthenticatedMixin, View):
+    """
+    Registers or deregisters a tutor for many future dates at once:
+    {"add": ["2024-09-13", ...], "remove": [...]}. Everything is applied in
+    one transaction, and the outcome per date is returned.
+    """
+
     def patch(self, request, *args, **kwargs):
         if not self.request.user.is_superuser:
             return HttpResponse(status=403)
 
         body = loads(request.body.decode("utf8"))
-        if "add" in body:
-            for add in body["add"]:
-                add_date = parse_date(add)
-                register_future(
-                    add_date,
-                    Slot.objects.filter(
-                        name=list(DAY_NUMBERS.keys())[
-                            list(DAY_NUMBERS.values()).index(add_date.weekday())
-                        ]
-                    ).first(),
-                    request.user,
-                )
+        results = {}
+        with transaction.atomic():
+            slots = get_weekday_slots()
+            add = parse_future_dates(body.get("add", []), slots, results)
+            remove = parse_future_dates(body.get("remove", []), slots, results)
+            if register_future_many(request.user, add, results):
+                StateVersion.bump()
+            # Removals bump the version themselves
+            deregister_future_many(request.user, remove, results)
+
+        return JsonResponse({"error": None, "results": results})
+
+
+@method_decorator(csrf_exempt, name="dispatch")
+class Recurring(AuthenticatedMixin, View):
+    """
+    The recurring registrations of a tutor. A new one is posted as
+    {"name": "fri", "pod": "e", "until": "2027-06-30"}.
+    """
+
+    @staticmethod
+    def rule_dict(rule):
+        return {
+            "id": rule.pk,
+            "name": rule.name,
+            "pod": rule.pod,
+            "start": rule.start,
+            "until": rule.until,
+        }
+
+    def get(self, request, *args, **kwargs):
+        if not self.request.user.is_superuser:
+            return HttpResponse(status=403)
+
+        rules = RecurringPresence.objects.filter(user=request.user).order_by("start")
+        return JsonResponse({"rules": [self.rule_dict(rule) for rule in rules]})
+
+    def post(self, request, *args, **kwargs):
+        if not self.request.user.is_superuser:
+            return HttpResponse(status=403)
 
-        if "remove" in body:
-            for remove in body["remove"]:
-                remove_date = parse_date(remove)
-                deregister_future(
-                    remove_date,
-                    Slot.objects.filter(
-                        name=list(DAY_NUMBERS.keys())[
-                            list(DAY_NUMBERS.values()).index(remove_date.weekday())
-                        ]
-                    ).first(),
-                    request.user,
+        try:
+            body = loads(request.body.decode("utf8"))
+        except ValueError:
+            body = None
+        if not isinstance(body, dict) or not all(
+            isinstance(body.get(field), str) for field in ("name", "pod", "until")
+        ):
+            return HttpResponseBadRequest("Expected name, pod and until")
+        try:
+            until = parse_date(body["until"])
+        except ValueError:
+            until = None
+        if until is None or until < date.today():
+            return HttpResponseBadRequest("Invalid until date")
+        if not Slot.get(body["name"], body["pod"]):
+            return HttpResponseBadRequest("Unknown slot")
+
+        try:
+            with transaction.atomic():
+                rule = RecurringPresence.objects.create(
+                    user=request.user, name=body["name"], pod=body["pod"], until=until
                 )
+        except IntegrityError:
+            return HttpResponseBadRequest("Rule already exists")
+        return JsonResponse(self.rule_dict(rule), status=201)
+
+    def delete(self, request, *args, **kwargs):
+        if not self.request.user.is_superuser:
+            return HttpResponse(status=403)
 
+        # Stops the rule, the dates it already registered for are kept
+        rule = RecurringPresence.objects.filter(
+            pk=kwargs.get("pk"), user=request.user
+        ).first()
+        if rule is None:
+            return HttpResponse(status=404)
+        rule.delete()
         return JsonResponse({"error": None})
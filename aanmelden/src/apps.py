@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class SrcConfig(AppConfig):
     name = "aanmelden.src"
+
+    def ready(self):
+        # pylint: disable-next=import-outside-toplevel,unused-import
+        from aanmelden.src import signals
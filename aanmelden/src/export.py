@@ -0,0 +1,84 @@
+import csv
+import datetime
+import itertools
+import json
+
+from asgiref.sync import sync_to_async
+from django.core.serializers.json import DjangoJSONEncoder
+
+from aanmelden.src.models import ArchivedPresence, Presence
+
+FIELDS = {
+    "date": "date",
+    "pod": "pod",
+    "username": "user__username",
+    "first_name": "user__first_name",
+    "last_name": "user__last_name",
+    "is_tutor": "is_tutor",
+    "seen": "seen",
+    "seen_by": "seen_by",
+}
+
+
+def presence_rows(start, end, chunk_size=2000):
+    """
+    All presences between the dates (inclusive), archived ones included, as
+    tuples of FIELDS ordered by date. The range is read one month at a time,
+    each month through iterator(), so memory use does not depend on the size
+    of the range and no read stays open for long.
+    """
+    columns = list(FIELDS.values())
+    after_end = end + datetime.timedelta(days=1)
+    while start <= end:
+        next_month = (start.replace(day=1) + datetime.timedelta(days=31)).replace(day=1)
+        month = {"date__gte": start, "date__lt": min(next_month, after_end)}
+        yield from (
+            Presence.objects.filter(**month)
+            .values_list(*columns)
+            .union(
+                ArchivedPresence.objects.filter(**month).values_list(*columns),
+                all=True,
+            )
+            .order_by("date", "pod")
+            .iterator(chunk_size=chunk_size)
+        )
+        start = next_month
+
+
+class Echo:
+    """A file-like object for csv.writer that returns the line it is given"""
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow(FIELDS.keys())
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def ndjson_lines(rows):
+    for row in rows:
+        yield json.dumps(dict(zip(FIELDS, row)), cls=DjangoJSONEncoder) + "\n"
+
+
+FORMATS = {
+    "csv": (csv_lines, "text/csv"),
+    "ndjson": (ndjson_lines, "application/x-ndjson"),
+}
+
+
+async def stream_async(lines, batch_size=500):
+    """
+    Serve a synchronous iterator from an ASGI server, which would otherwise
+    read it completely before sending anything
+    """
+    lines = iter(lines)
+
+    def next_batch():
+        return "".join(itertools.islice(lines, batch_size))
+
+    while chunk := await sync_to_async(next_batch)():
+        yield chunk
@@ -0,0 +1,64 @@
+import json
+import threading
+from concurrent.futures import Future
+
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+
+from aanmelden.src import metrics
+from aanmelden.src.models import Slot
+
+
+class FreeSlotsCache:
+    """
+    The encoded body of /api/v2/free, which is the same for everyone. Only the
+    body of the latest version is kept, under a single cache key, so a hit is
+    one cache read. When the version changes, concurrent requests share a
+    single rebuild.
+    """
+
+    key = "free-slots"
+    timeout = 3600
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.builds = {}
+
+    def get_body(self, version) -> bytes:
+        cached = cache.get(self.key)
+        if cached is not None and cached[0] == version:
+            metrics.increment("free_slots_hits")
+            return cached[1]
+
+        with self.lock:
+            build = self.builds.get(version)
+            leader = build is None
+            if leader:
+                build = self.builds[version] = Future()
+        if not leader:
+            # Another thread is already building this version
+            return build.result(timeout=30)
+
+        metrics.increment("free_slots_builds")
+        try:
+            body = self.build()
+            cache.set(self.key, (version, body), timeout=self.timeout)
+            build.set_result(body)
+        except Exception as e:
+            build.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.builds[version]
+        return body
+
+    @staticmethod
+    def build() -> bytes:
+        slots = Slot.get_enabled_slots()
+        for slot in slots:
+            slot.pop("tutors", None)
+            slot.pop("is_registered", None)
+        return json.dumps(slots, cls=DjangoJSONEncoder).encode()
+
+
+free_slots_cache = FreeSlotsCache()
@@ -0,0 +1,93 @@
+import hashlib
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+import requests
+from django.conf import settings
+from django.core.cache import cache
+from oauthlib.oauth2 import BackendApplicationClient, OAuth2Error
+from requests_oauthlib import OAuth2Session
+
+logger = logging.getLogger(__name__)
+
+
+class IntrospectionClient:
+    """
+    Asks the IdP about client tokens. One OAuth2 session (and its connection
+    pool) is reused for all calls. Concurrent lookups of the same token share
+    a single call, and results are cached by token hash until the token
+    expires.
+    """
+
+    timeout = 10
+    # Results are never cached longer than this
+    max_cache_timeout = 1800
+
+    def __init__(self):
+        self.oauth = OAuth2Session(
+            client=BackendApplicationClient(
+                client_id=settings.INTROSPECTION_CLIENT_ID, scope=["introspection"]
+            )
+        )
+        self.lock = threading.Lock()
+        self.token_lock = threading.Lock()
+        self.calls = {}
+
+    def introspect(self, token) -> dict:
+        key = f"introspection-{hashlib.sha256(token.encode()).hexdigest()}"
+        result = cache.get(key)
+        if result is not None:
+            return result
+
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Future()
+        if not leader:
+            # Another thread is already asking the IdP about this token
+            try:
+                return call.result(timeout=self.timeout * 3)
+            except TimeoutError:
+                logger.warning("Waiting for a client token introspection timed out")
+                return {"active": False}
+
+        result = {"active": False}
+        try:
+            result = self.fetch(token)
+            cache.set(key, result, timeout=self.cache_timeout(result))
+        except (requests.RequestException, OAuth2Error, ValueError):
+            # Not cached, the next request tries again
+            logger.exception("Introspecting a client token failed")
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.set_result(result)
+        return result
+
+    def cache_timeout(self, result):
+        timeout = self.max_cache_timeout
+        if result.get("active") and "exp" in result:
+            timeout = min(timeout, int(result["exp"] - time.time()))
+        return max(timeout, 1)
+
+    def fetch(self, token):
+        with self.token_lock:
+            # Get a token with introspection scope, or a new one if it expired
+            if (self.oauth.token or {}).get("expires_at", 0) < time.time() + 30:
+                self.oauth.fetch_token(
+                    token_url=settings.IDP_TOKEN_URL,
+                    client_secret=settings.INTROSPECTION_CLIENT_SECRET,
+                    timeout=self.timeout,
+                )
+
+        response = self.oauth.post(
+            settings.IDP_INTROSPECTION_URL, data={"token": token}, timeout=self.timeout
+        )
+        response.raise_for_status()
+        return response.json()
+
+
+introspection_client = IntrospectionClient()
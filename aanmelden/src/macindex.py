@@ -0,0 +1,93 @@
+import datetime
+import threading
+import time
+
+from aanmelden.src import metrics
+from aanmelden.src.models import MacAddress
+
+
+class MacIndex:
+    """
+    The owners of all known MAC addresses and the users that were already seen
+    today, so repeated joins of the same devices need no queries.
+
+    The index is loaded on first use and kept current by the MacAddress and
+    Presence signals of this process. It is reloaded every `lifespan` seconds
+    to pick up changes made by other processes, which also forgets who was
+    seen, as another process may have unmarked or re-registered them.
+    """
+
+    lifespan = 300
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.owners = None
+        self.macs = {}
+        self.loaded_at = 0
+        self.day = None
+        self.seen = set()
+
+    def clear(self):
+        with self.lock:
+            self.owners = None
+            self.macs = {}
+            self.day = None
+            self.seen = set()
+
+    def load(self):
+        owners = {}
+        macs = {}
+        for pk, mac, user in MacAddress.objects.values_list("pk", "mac", "user"):
+            owners[mac] = user
+            macs[pk] = mac
+        self.owners = owners
+        self.macs = macs
+        self.seen = set()
+        self.loaded_at = time.monotonic()
+        metrics.increment("mac_index_loads")
+
+    def get_owners(self, macs) -> dict:
+        with self.lock:
+            if self.owners is None or time.monotonic() - self.loaded_at > self.lifespan:
+                self.load()
+            return {mac: self.owners[mac] for mac in macs if mac in self.owners}
+
+    def mac_saved(self, mac_address):
+        with self.lock:
+            if self.owners is None:
+                return
+            old_mac = self.macs.get(mac_address.pk)
+            if old_mac is not None:
+                self.owners.pop(old_mac, None)
+            self.owners[mac_address.mac] = mac_address.user_id
+            self.macs[mac_address.pk] = mac_address.mac
+
+    def mac_deleted(self, mac_address):
+        with self.lock:
+            if self.owners is None:
+                return
+            self.owners.pop(self.macs.pop(mac_address.pk, mac_address.mac), None)
+
+    def seen_today(self) -> set:
+        # Called with the lock held
+        today = datetime.date.today()
+        if self.day != today:
+            self.day = today
+            self.seen = set()
+        return self.seen
+
+    def is_seen(self, user):
+        with self.lock:
+            return user in self.seen_today()
+
+    def mark_seen(self, users):
+        with self.lock:
+            self.seen_today().update(users)
+
+    def mark_unseen(self, user, date):
+        with self.lock:
+            if date == self.day:
+                self.seen.discard(user)
+
+
+mac_index = MacIndex()
@@ -0,0 +1,40 @@
+import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from aanmelden.src.models import Occupancy
+from aanmelden.src.signals import archive_presences
+
+
+class Command(BaseCommand):
+    help = "Move presences older than PRESENCE_ARCHIVE_DAYS to the archive"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days",
+            type=int,
+            default=getattr(settings, "PRESENCE_ARCHIVE_DAYS", 365),
+            help="Archive the presences older than this many days",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Number of presences moved per transaction",
+        )
+
+    def handle(self, *args, **options):
+        if options["days"] < 31:
+            # The calendar shows the current month
+            raise CommandError("Presences of the last 31 days can not be archived")
+
+        before = datetime.date.today() - datetime.timedelta(days=options["days"])
+        archived = 0
+        # Short transactions, so registrations are not blocked for long
+        while moved := archive_presences(before, options["batch_size"]):
+            archived += moved
+        # The counters of archived dates are no longer needed
+        Occupancy.objects.filter(date__lt=before).delete()
+
+        self.stdout.write(f"Archived {archived} presences from before {before}")
@@ -0,0 +1,98 @@
+import datetime
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from aanmelden.src.models import DjoUser, Presence
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure the insert and delete throughput of Presence and show the query "
+        "plans of its hot queries. Everything runs in a transaction that is rolled "
+        "back, run it before and after an index change to compare."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--count", type=int, default=5000, help="Number of presences to insert"
+        )
+
+    def handle(self, *args, **options):
+        count = options["count"]
+        with transaction.atomic():
+            self.show_indexes()
+            users = DjoUser.objects.bulk_create(
+                [DjoUser(username=f"benchmark-{i}") for i in range(count // 10 + 1)]
+            )
+            first_date = datetime.date.today() + datetime.timedelta(days=1)
+            presences = [
+                Presence(
+                    user=users[i % len(users)],
+                    date=first_date + datetime.timedelta(days=i // len(users)),
+                    pod="e",
+                )
+                for i in range(count)
+            ]
+
+            # One statement per row, like registrations during the rush
+            start = time.perf_counter()
+            for presence in presences:
+                Presence.objects.bulk_create([presence])
+            self.report("inserts", count, time.perf_counter() - start)
+
+            self.show_plans(users[0], first_date)
+
+            start = time.perf_counter()
+            with connection.cursor() as cursor:
+                for presence in presences:
+                    cursor.execute(
+                        f"DELETE FROM {Presence._meta.db_table} WHERE id = %s",
+                        [presence.pk],
+                    )
+            self.report("deletes", count, time.perf_counter() - start)
+
+            transaction.set_rollback(True)
+
+    def report(self, what, count, elapsed):
+        self.stdout.write(f"{count} {what} in {elapsed:.3f}s: {count / elapsed:.0f}/s")
+
+    def show_indexes(self):
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(
+                cursor, Presence._meta.db_table
+            )
+        for name, constraint in sorted(constraints.items()):
+            if constraint["index"] or constraint["unique"]:
+                columns = ", ".join(constraint["columns"])
+                self.stdout.write(f"Index {name}: ({columns})")
+
+    def show_plans(self, user, on_date):
+        week = on_date + datetime.timedelta(days=6)
+        queries = {
+            "Presences of a slot": Presence.objects.filter(date=on_date, pod="e"),
+            "Tutors of the slots": Presence.objects.filter(
+                date__in=[on_date, week], is_tutor=True
+            ).values_list("date", "pod", "user__first_name"),
+            "Registration of a user": Presence.objects.filter(
+                user=user, date=on_date, pod="e"
+            ),
+            "Registrations in a week": Presence.objects.filter(
+                user=user, date__gte=on_date, date__lte=week
+            ).values("pk"),
+            "MAC event": Presence.objects.filter(date=on_date, user__in=[user.pk]),
+            "Present in a slot": Presence.objects.filter(
+                date=on_date, pod="e", user__username=user.username, seen=True
+            ),
+            "Attendance head month": Presence.objects.filter(
+                user__username=user.username,
+                date__gte=on_date,
+                date__lt=week,
+                seen=True,
+            ).values("pk"),
+        }
+        for name, queryset in queries.items():
+            self.stdout.write(f"{name}:")
+            for line in queryset.explain().splitlines():
+                self.stdout.write(f"  {line}")
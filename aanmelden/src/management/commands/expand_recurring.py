@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+
+from aanmelden.src.models import RecurringPresence
+
+
+class Command(BaseCommand):
+    help = "Register the tutors of recurring rules for the upcoming window"
+
+    def handle(self, *args, **options):
+        RecurringPresence.expand_all()
@@ -0,0 +1,28 @@
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from aanmelden.src.export import FORMATS, presence_rows
+
+
+class Command(BaseCommand):
+    help = "Write all presences between two dates as CSV or NDJSON"
+
+    def add_arguments(self, parser):
+        parser.add_argument("from", help="First date, e.g. 2023-09-01")
+        parser.add_argument("--until", help="Last date, today if not given")
+        parser.add_argument("--format", choices=sorted(FORMATS), default="csv")
+
+    def handle(self, *args, **options):
+        try:
+            start = parse_date(options["from"])
+            until = parse_date(options["until"] or "") or datetime.date.today()
+        except ValueError as e:
+            raise CommandError(e) from e
+        if start is None:
+            raise CommandError(f"Invalid date: {options['from']}")
+
+        lines, _ = FORMATS[options["format"]]
+        for line in lines(presence_rows(start, until)):
+            self.stdout.write(line, ending="")
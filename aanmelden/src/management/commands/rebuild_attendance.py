@@ -0,0 +1,33 @@
+from aanmelden.src.management.rebuild import RebuildCommand
+from aanmelden.src.models import Attendance
+
+
+class Command(RebuildCommand):
+    help = "Rebuild the monthly attendance counters from the seen presences"
+    counters = "attendance counters"
+
+    def find_drift(self):
+        expected = Attendance.count_presences()
+        drift = []
+        for attendance in Attendance.objects.select_for_update():
+            seen = expected.pop((attendance.user_id, attendance.month), 0)
+            if attendance.seen != seen:
+                drift.append((attendance, seen))
+        missing = [
+            Attendance(user_id=user_id, month=month, seen=seen)
+            for (user_id, month), seen in expected.items()
+        ]
+        return drift, missing
+
+    def describe(self, counter, expected=None):
+        if expected is None:
+            return f"{counter.user_id}/{counter.month:%Y-%m}: missing -> {counter.seen}"
+        return f"{counter.user_id}/{counter.month:%Y-%m}: {counter.seen} -> {expected}"
+
+    def fix(self, drift, missing):
+        for attendance, seen in drift:
+            attendance.seen = seen
+        Attendance.objects.bulk_update(
+            [attendance for attendance, _ in drift], ["seen"]
+        )
+        Attendance.objects.bulk_create(missing)
@@ -0,0 +1,38 @@
+from aanmelden.src.management.rebuild import RebuildCommand
+from aanmelden.src.models import Occupancy
+
+
+class Command(RebuildCommand):
+    help = "Rebuild the occupancy counters from the registered presences"
+    counters = "occupancy counters"
+
+    def find_drift(self):
+        expected = Occupancy.count_presences()
+        drift = []
+        for occupancy in Occupancy.objects.select_for_update():
+            key = (occupancy.date, occupancy.pod)
+            counts = expected.pop(key, (0, 0))
+            if (occupancy.members, occupancy.tutors) != counts:
+                drift.append((occupancy, counts))
+        missing = [
+            Occupancy(date=on_date, pod=pod, members=members, tutors=tutors)
+            for (on_date, pod), (members, tutors) in expected.items()
+        ]
+        return drift, missing
+
+    def describe(self, counter, expected=None):
+        if expected is None:
+            return f"{counter.date}/{counter.pod}: missing -> {counter.members}/{counter.tutors}"
+        return (
+            f"{counter.date}/{counter.pod}: "
+            f"{counter.members}/{counter.tutors} -> {expected[0]}/{expected[1]}"
+        )
+
+    def fix(self, drift, missing):
+        for occupancy, (members, tutors) in drift:
+            occupancy.members = members
+            occupancy.tutors = tutors
+        Occupancy.objects.bulk_update(
+            [occupancy for occupancy, _ in drift], ["members", "tutors"]
+        )
+        Occupancy.objects.bulk_create(missing)
@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+
+class RebuildCommand(BaseCommand):
+    """
+    Base for the commands that recount denormalized counters. Subclasses find
+    the drifted and missing counters and know how to fix them.
+    """
+
+    counters = "counters"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--check",
+            action="store_true",
+            help="Only report drift, exit with status 1 if any is found",
+        )
+
+    def find_drift(self):
+        """Returns ([(counter, expected), ...], [missing counter, ...])"""
+        raise NotImplementedError
+
+    def describe(self, counter, expected=None):
+        raise NotImplementedError
+
+    def fix(self, drift, missing):
+        raise NotImplementedError
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            drift, missing = self.find_drift()
+
+            for counter, expected in drift:
+                self.stdout.write(self.describe(counter, expected))
+            for counter in missing:
+                self.stdout.write(self.describe(counter))
+
+            if options["check"]:
+                if drift or missing:
+                    raise CommandError(
+                        f"Found {len(drift) + len(missing)} drifted {self.counters}",
+                        returncode=1,
+                    )
+                self.stdout.write("No drift found")
+                return
+
+            self.fix(drift, missing)
+
+        self.stdout.write(f"Rebuilt {len(drift) + len(missing)} {self.counters}")
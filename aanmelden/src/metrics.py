@@ -0,0 +1,17 @@
+import os
+import threading
+from collections import Counter
+
+# Counters of the current process, each uvicorn process keeps its own
+_counters = Counter()
+_lock = threading.Lock()
+
+
+def increment(name, amount=1):
+    with _lock:
+        _counters[name] += amount
+
+
+def snapshot() -> dict:
+    with _lock:
+        return {"pid": os.getpid(), "counters": dict(_counters)}
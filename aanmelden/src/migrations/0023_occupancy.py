@@ -0,0 +1,41 @@
+# Generated by Django 6.1 on 2026-10-18 15:16
+
+from django.db import migrations, models
+
+
+def count_presences(apps, schema_editor):
+    Presence = apps.get_model('src', 'Presence')
+    Occupancy = apps.get_model('src', 'Occupancy')
+    occupancies = {}
+    for row in Presence.objects.values('date', 'pod', 'user__is_superuser').annotate(count=models.Count('id')).order_by():
+        occupancy = occupancies.setdefault((row['date'], row['pod']), Occupancy(date=row['date'], pod=row['pod']))
+        if row['user__is_superuser']:
+            occupancy.tutors = row['count']
+        else:
+            occupancy.members = row['count']
+    Occupancy.objects.bulk_create(occupancies.values(), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('src', '0022_userinfo_stripcard_expires'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Occupancy',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('pod', models.CharField(choices=[('m', 'Ochtend'), ('a', 'Middag'), ('e', 'Avond')], max_length=1, null=True)),
+                ('members', models.IntegerField(default=0)),
+                ('tutors', models.IntegerField(default=0)),
+            ],
+            options={
+                'verbose_name_plural': 'Occupancies',
+                'unique_together': {('date', 'pod')},
+            },
+        ),
+        migrations.RunPython(count_presences, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 6.1 on 2026-10-18 15:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('src', '0023_occupancy'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StateVersion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.BigIntegerField(default=0)),
+            ],
+        ),
+    ]
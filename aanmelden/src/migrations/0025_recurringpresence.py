@@ -0,0 +1,27 @@
+# Generated by Django 6.1 on 2026-10-18 15:52
+
+import datetime
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('src', '0024_stateversion'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecurringPresence',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(choices=[('mon', 'Maandag'), ('tue', 'Dinsdag'), ('wed', 'Woensdag'), ('thu', 'Donderdag'), ('fri', 'Vrijdag'), ('sat', 'Zaterdag'), ('sun', 'Zondag')], max_length=3)),
+                ('pod', models.CharField(choices=[('m', 'Ochtend'), ('a', 'Middag'), ('e', 'Avond')], max_length=1)),
+                ('start', models.DateField(default=datetime.date.today)),
+                ('until', models.DateField()),
+                ('expanded_until', models.DateField(blank=True, editable=False, null=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='src.djouser')),
+            ],
+        ),
+    ]
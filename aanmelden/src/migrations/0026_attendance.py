@@ -0,0 +1,38 @@
+# Generated by Django 6.1 on 2026-10-18 15:56
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models.functions import TruncMonth
+
+
+def count_presences(apps, schema_editor):
+    Presence = apps.get_model('src', 'Presence')
+    Attendance = apps.get_model('src', 'Attendance')
+    rows = Presence.objects.filter(seen=True).annotate(month=TruncMonth('date')).values('user', 'month').annotate(count=models.Count('id')).order_by()
+    Attendance.objects.bulk_create(
+        [Attendance(user_id=row['user'], month=row['month'], seen=row['count']) for row in rows],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('src', '0025_recurringpresence'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Attendance',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField()),
+                ('seen', models.IntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='src.djouser')),
+            ],
+            options={
+                'unique_together': {('user', 'month')},
+            },
+        ),
+        migrations.RunPython(count_presences, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 6.1 on 2026-10-18 16:05
+
+from django.db import migrations, models
+
+
+def backfill_is_tutor(apps, schema_editor):
+    Presence = apps.get_model('src', 'Presence')
+    Presence.objects.filter(user__is_superuser=True).update(is_tutor=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('src', '0026_attendance'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='presence',
+            name='is_tutor',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.RunPython(backfill_is_tutor, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='presence',
+            index=models.Index(fields=['date', 'pod', 'is_tutor'], name='src_presenc_date_049f9f_idx'),
+        ),
+    ]
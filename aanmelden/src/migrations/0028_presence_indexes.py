@@ -0,0 +1,35 @@
+# Generated by Django 6.1 on 2026-10-18 16:06
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('src', '0027_presence_is_tutor'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='presence',
+            name='src_presenc_date_c6e781_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='presence',
+            name='src_presenc_date_891774_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='presence',
+            name='src_presenc_date_3c722b_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='presence',
+            name='src_presenc_date_b8b9f2_idx',
+        ),
+        migrations.AlterField(
+            model_name='presence',
+            name='user',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='src.djouser'),
+        ),
+    ]
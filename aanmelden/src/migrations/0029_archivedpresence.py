@@ -0,0 +1,29 @@
+# Generated by Django 6.1 on 2026-10-18 16:08
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('src', '0028_presence_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedPresence',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('pod', models.CharField(choices=[('m', 'Ochtend'), ('a', 'Middag'), ('e', 'Avond')], max_length=1, null=True)),
+                ('seen', models.BooleanField(default=False)),
+                ('seen_by', models.CharField(choices=[('mac', 'Mac Adres'), ('manual', 'Handmatig Aangemeld')], default='manual', max_length=6)),
+                ('is_tutor', models.BooleanField(default=False)),
+                ('user', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='src.djouser')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', 'date'], name='src_archive_user_id_719091_idx'), models.Index(fields=['date'], name='src_archive_date_faf37c_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 6.1 on 2026-10-18 16:57
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('src', '0029_archivedpresence'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecurringException',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('rule', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='exceptions', to='src.recurringpresence')),
+            ],
+            options={
+                'unique_together': {('rule', 'date')},
+            },
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 6.1 on 2026-10-18 17:02
+
+from django.db import migrations, models
+
+
+def remove_duplicates(apps, schema_editor):
+    # Keep the rule that runs the longest of every (user, name, pod)
+    RecurringPresence = apps.get_model('src', 'RecurringPresence')
+    duplicates = (
+        RecurringPresence.objects.values('user', 'name', 'pod')
+        .annotate(count=models.Count('id'))
+        .filter(count__gt=1)
+        .order_by()
+    )
+    for duplicate in duplicates:
+        rules = RecurringPresence.objects.filter(
+            user=duplicate['user'], name=duplicate['name'], pod=duplicate['pod']
+        ).order_by('-until', 'pk')
+        RecurringPresence.objects.filter(
+            pk__in=[rule.pk for rule in rules[1:]]
+        ).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('src', '0030_recurringexception'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicates, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='recurringpresence',
+            unique_together={('user', 'name', 'pod')},
+        ),
+    ]
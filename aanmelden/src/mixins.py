@@ -1,12 +1,14 @@
+import hashlib
+import time
+
 import jwt
-from django.conf import settings
-from django.contrib.auth import login as auth_login
+import requests
 from django.contrib.auth.mixins import UserPassesTestMixin
 from django.core.cache import cache
 from django.http.response import HttpResponseForbidden, HttpResponseNotFound
-from oauthlib.oauth2 import BackendApplicationClient
-from requests_oauthlib import OAuth2Session
 
+from aanmelden.src import metrics
+from aanmelden.src.introspection import introspection_client
 from aanmelden.src.models import Slot, DjoUser, UserInfo
 from aanmelden.src.utils import (
     get_access_token,
@@ -25,59 +27,30 @@ class ClientCredentialsRequiredMixin:
     whitelisted_client_ids = []
 
     def validate_client_token(self, client_token) -> bool:
-        # Get a token with introspection scope
-        client = BackendApplicationClient(
-            client_id=settings.INTROSPECTION_CLIENT_ID, scope=["introspection"]
-        )
-        oauth = OAuth2Session(client=client)
-        introspection_token = cache.get("introspection_token")
-        if not introspection_token:
-            # No cached token found -> get a new one
+        if is_jwt(client_token):
+            # Signed by the IdP, so it can be verified without asking it
             try:
-                introspection_token = oauth.fetch_token(
-                    token_url=settings.IDP_TOKEN_URL,
-                    client_secret=settings.INTROSPECTION_CLIENT_SECRET,
-                )
-            except Exception as e:  # pylint: disable=broad-exception-caught
-                # Failed to get an introspection token -> bail
-                print(e)
+                claims = decode_access_token(client_token, require=["exp"])
+                return claims.get("client_id") in self.whitelisted_client_ids
+            except jwt.PyJWTError:
                 return False
-
-            cache.set(
-                "introspection_token",
-                introspection_token,
-                timeout=introspection_token["expires_in"],
-            )
-        else:
-            oauth.token = introspection_token
-
-        # We now have a token that allows us to call the introspection endpoint
-        # Call it to verify the client_token we received
-        response = oauth.post(
-            settings.IDP_INTROSPECTION_URL, data={"token": client_token}
+            except requests.RequestException:
+                # The signing keys are not available, let the IdP decide
+                pass
+
+        # Opaque token, only the IdP knows about it
+        result = introspection_client.introspect(client_token)
+        return bool(
+            result.get("active")
+            and result.get("client_id") in self.whitelisted_client_ids
         )
-        if not response.ok:
-            # The token we verified was not valid
-            return False
-
-        result = response.json()
-        if result["active"] and result["client_id"] in self.whitelisted_client_ids:
-            return True
-
-        return False
 
     def dispatch(self, request, *args, **kwargs):
         client_access_token = get_access_token(request)
         if not client_access_token:
             return HttpResponseForbidden()
 
-        token_valid = cache.get(client_access_token)
-        if token_valid is None:
-            # No cached result found for this token, query IDP
-            token_valid = self.validate_client_token(client_access_token)
-            cache.set(client_access_token, token_valid, timeout=1800)
-
-        if not token_valid:
+        if not self.validate_client_token(client_access_token):
             return HttpResponseForbidden()
 
         return super().dispatch(request, *args, **kwargs)
@@ -105,50 +78,117 @@ class SlotContextMixin:
         return super().dispatch(request, *args, **kwargs)
 
 
+def is_jwt(token) -> bool:
+    try:
+        jwt.get_unverified_header(token)
+    except jwt.DecodeError:
+        return False
+    return True
+
+
+def decode_access_token(token, require=()):
+    openid_configuration = get_openid_configuration()
+    jwks_client = get_jwks_client()
+
+    signing_key = jwks_client.get_signing_key_from_jwt(token)
+    return jwt.decode(
+        token,
+        key=signing_key.key,
+        algorithms=openid_configuration["id_token_signing_alg_values_supported"],
+        options={"verify_aud": False, "require": list(require)},
+    )
+
+
+# Verified claims and their user are cached for at most this many seconds
+CLAIM_CACHE_TIMEOUT = 300
+
+
+def assign_changed(instance, values) -> list:
+    """Set the given field values on instance, returns the fields that changed"""
+    changed = []
+    for name, value in values.items():
+        value = instance._meta.get_field(name).to_python(value)
+        if getattr(instance, name) != value:
+            setattr(instance, name, value)
+            changed.append(name)
+    return changed
+
+
+def sync_user(claims) -> DjoUser:
+    """
+    Get or create the user of the claims, and update the user and its userinfo
+    with them. Rows are only written when a claim actually changed.
+    """
+    username = f"idp-{claims['sub']}"
+    user = DjoUser.objects.select_related("userinfo").filter(username=username).first()
+    if user is None:
+        user = DjoUser(username=username)
+        user.set_unusable_password()
+
+    fields = assign_changed(
+        user,
+        {
+            "email": claims["email"],
+            "first_name": claims["given_name"],
+            "last_name": claims["family_name"],
+            "is_superuser": user.is_begeleider(claims["account_type"]),
+        },
+    )
+    if user.pk is None:
+        user.save()
+    elif fields:
+        user.save(update_fields=fields)
+
+    if not hasattr(user, "userinfo"):
+        user.userinfo = UserInfo(user=user)
+    userinfo = {
+        "days": claims["days"],
+        "account_type": claims["account_type"],
+        # No active stripcard -> reset counters
+        "stripcard_used": 0,
+        "stripcard_count": 0,
+    }
+    if claims["stripcard"] is not None:
+        userinfo.update(
+            stripcard_used=claims["stripcard"]["used"],
+            stripcard_count=claims["stripcard"]["count"],
+            stripcard_expires=claims["stripcard"]["expires"],
+        )
+    fields = assign_changed(user.userinfo, userinfo)
+    if user.userinfo.pk is None:
+        user.userinfo.save()
+    elif fields:
+        user.userinfo.save(update_fields=fields)
+
+    return user
+
+
 class AuthenticatedMixin:
     def dispatch(self, request, *args, **kwargs):
         token = get_access_token(request)
         if not token:
             return HttpResponseForbidden()
 
-        openid_configuration = get_openid_configuration()
-        jwks_client = get_jwks_client()
+        cache_key = f"claims-{hashlib.sha256(token.encode()).hexdigest()}"
+        cached = cache.get(cache_key)
+        if cached is None:
+            decoded_jwt = decode_access_token(token)
+            user = sync_user(decoded_jwt) if decoded_jwt["aanmelden"] else None
+            # Never keep the claims beyond the expiry of the token
+            timeout = CLAIM_CACHE_TIMEOUT
+            if "exp" in decoded_jwt:
+                timeout = min(timeout, int(decoded_jwt["exp"] - time.time()))
+            if timeout > 0:
+                cache.set(cache_key, (decoded_jwt, user), timeout=timeout)
+        else:
+            decoded_jwt, user = cached
 
-        signing_key = jwks_client.get_signing_key_from_jwt(token)
-        decoded_jwt = jwt.decode(
-            token,
-            key=signing_key.key,
-            algorithms=openid_configuration["id_token_signing_alg_values_supported"],
-            options={"verify_aud": False},
-        )
         if not decoded_jwt["aanmelden"]:
             return HttpResponseForbidden()
 
-        username = f"idp-{decoded_jwt['sub']}"
-        try:
-            user = DjoUser.objects.get(username=username)
-        except DjoUser.DoesNotExist:
-            user = DjoUser(username=username)
-            user.set_unusable_password()
-
-        if not hasattr(user, "userinfo"):
-            user.userinfo = UserInfo()
-        user.email = decoded_jwt["email"]
-        user.first_name = decoded_jwt["given_name"]
-        user.last_name = decoded_jwt["family_name"]
-        user.is_superuser = user.is_begeleider(decoded_jwt["account_type"])
-        user.userinfo.days = decoded_jwt["days"]
-        user.userinfo.account_type = decoded_jwt["account_type"]
-        if decoded_jwt["stripcard"] is not None:
-            user.userinfo.stripcard_used = decoded_jwt["stripcard"]["used"]
-            user.userinfo.stripcard_count = decoded_jwt["stripcard"]["count"]
-            user.userinfo.stripcard_expires = decoded_jwt["stripcard"]["expires"]
-        else:
-            # No active stripcard -> reset counters
-            user.userinfo.stripcard_used = 0
-            user.userinfo.stripcard_count = 0
-
-        user.save()
-        auth_login(request, user)
+        # Stateless: the token is sent with every request, so there is no need
+        # to log in and create (or rotate) a session for it
+        request.user = user
+        metrics.increment("session_writes_avoided")
 
         return super().dispatch(request, *args, **kwargs)
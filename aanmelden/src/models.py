@@ -1,8 +1,10 @@
+import collections
 import datetime
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.db import models
+from django.db import models, transaction
+from django.db.models.functions import TruncMonth
 from django.forms.models import model_to_dict
 from django.utils import timezone
 
@@ -41,6 +43,14 @@ class DjoUser(DjangoUser):
             or "ondersteuning" in types
         )
 
+    @staticmethod
+    def lock(pk):
+        """
+        Lock the user until the transaction ends. Taken before writing
+        presences of the user, so their counters are adjusted one at a time.
+        """
+        DjoUser.objects.select_for_update().filter(pk=pk).exists()
+
     @staticmethod
     def has_strippenkaart(account_type):
         types = account_type.split(",")
@@ -101,11 +111,12 @@ class Slot(models.Model):
 
     @property
     def tutors(self):
+        pending = RecurringPresence.pending_tutors([self.date])
         return list(
             Presence.objects.filter(
-                date=self.date, pod=self.pod, user__is_superuser=True
+                date=self.date, pod=self.pod, is_tutor=True
             ).values_list("user__first_name", flat=True)
-        )
+        ) + pending.get((self.date, self.pod), [])
 
     @property
     def announcement(self):
@@ -122,23 +133,53 @@ class Slot(models.Model):
 
     @staticmethod
     def get_enabled_slots(user=None):
-        slots = Slot.objects.filter(enabled=True)
+        """
+        Build a snapshot of all enabled slots for the current week.
+
+        Uses a fixed number of queries regardless of the amount of slots and
+        registrations, instead of evaluating the per-slot properties.
+        """
+        slots = list(Slot.objects.filter(enabled=True))
+        dates = {slot.date for slot in slots}
+
+        special_dates = {
+            (special_date.date, special_date.pod): special_date
+            for special_date in SpecialDate.objects.filter(date__in=dates)
+        }
+
+        counts = Presence.get_counts(dates)
+
+        registered = set()
+        if user:
+            registered = set(
+                Presence.objects.filter(user=user, date__in=dates).values_list(
+                    "date", "pod"
+                )
+            )
+
         available_slots = []
         for slot in slots:
+            key = (slot.date, slot.pod)
+            special_date = SpecialDate.find(special_dates, *key)
+            slot_counts = counts.get(key, {"taken": 0, "tutor_count": 0, "tutors": []})
+
             available_slot = model_to_dict(slot)
             available_slot.pop("id")
-            for field in [
-                "date",
-                "taken",
-                "available",
-                "closed",
-                "tutor_count",
-                "tutors",
-                "announcement",
-            ]:
-                available_slot[field] = getattr(slot, field)
+            available_slot["date"] = slot.date
+            available_slot["taken"] = slot_counts["taken"]
+            available_slot["available"] = (
+                Presence.capacity(special_date, slot_counts["tutor_count"])
+                - slot_counts["taken"]
+            )
+            available_slot["closed"] = bool(special_date and special_date.closed)
+            available_slot["tutor_count"] = slot_counts["tutor_count"]
+            available_slot["tutors"] = slot_counts["tutors"]
+            exact_special_date = special_dates.get(key)
+            available_slot["announcement"] = (
+                exact_special_date.announcement if exact_special_date else ""
+            )
             if user:
-                available_slot["is_registered"] = slot.is_registered(user)
+                available_slot["is_registered"] = key in registered
             available_slots.append(available_slot)
         return available_slots
 
@@ -154,63 +195,607 @@ class Slot(models.Model):
 class Presence(models.Model):
     class Meta:
         unique_together = ("user", "date", "pod")
-        indexes = [
-            models.Index(fields=["date", "pod"]),
-            models.Index(fields=["date", "user"]),
-            models.Index(fields=["date", "user", "pod"]),
-            models.Index(fields=["date"]),
-        ]
+        # Lookups by user use the unique (user, date, pod) index, lookups by
+        # date or slot this one. See the benchmark_presence command.
+        indexes = [models.Index(fields=["date", "pod", "is_tutor"])]
 
     @staticmethod
     def get_tutor_count(date, pod=None):
+        pending = RecurringPresence.pending_tutor_count(date, pod)
         if pod:
-            return Presence.objects.filter(
-                date=date, pod=pod, user__is_superuser=True
-            ).count()
-        return Presence.objects.filter(date=date, user__is_superuser=True).count()
+            return Occupancy.get(date, pod).tutors + pending
+        return (
+            Occupancy.objects.filter(date=date).aggregate(
+                tutors=models.Sum("tutors", default=0)
+            )["tutors"]
+            + pending
+        )
 
     @staticmethod
-    def slots_available(on_date, pod=None):
-        try:
-            special_date = SpecialDate.objects.get(date=on_date, pod=pod)
-        except SpecialDate.DoesNotExist:
-            try:
-                special_date = SpecialDate.objects.get(date=on_date, pod=None)
-            except SpecialDate.DoesNotExist:
-                special_date = None
+    def get_counts(dates):
+        """Member count, tutor count and tutor names per (date, pod)"""
+        counts = {}
+        for occupancy in Occupancy.objects.filter(date__in=dates):
+            counts[(occupancy.date, occupancy.pod)] = {
+                "taken": occupancy.members,
+                "tutor_count": occupancy.tutors,
+                "tutors": [],
+            }
+
+        for on_date, pod, first_name in Presence.objects.filter(
+            date__in=dates, is_tutor=True
+        ).values_list("date", "pod", "user__first_name"):
+            counts.setdefault(
+                (on_date, pod), {"taken": 0, "tutor_count": 0, "tutors": []}
+            )["tutors"].append(first_name)
+
+        # Tutors that will register through a recurring rule later on
+        for key, first_names in RecurringPresence.pending_tutors(dates).items():
+            slot_counts = counts.setdefault(
+                key, {"taken": 0, "tutor_count": 0, "tutors": []}
+            )
+            slot_counts["tutor_count"] += len(first_names)
+            slot_counts["tutors"].extend(first_names)
+
+        return counts
 
-        slots_available = 0
+    @staticmethod
+    def capacity(special_date, tutor_count):
         if special_date and special_date.free_slots >= 0:
-            slots_available = special_date.free_slots
             if special_date.closed:
-                slots_available = 0
-        else:
-            # Add more slots depending on nr of tutors
-            tutor_count = Presence.get_tutor_count(on_date, pod)
-            for amount, extra in settings.SLOT_LEVELS.items():
-                if tutor_count >= amount:
-                    slots_available += extra
+                return 0
+            return special_date.free_slots
+
+        # Add more slots depending on nr of tutors
+        capacity = 0
+        for amount, extra in settings.SLOT_LEVELS.items():
+            if tutor_count >= amount:
+                capacity += extra
+        return capacity
+
+    @staticmethod
+    def available_in(occupancy, special_date):
+        """
+        The free places of the slot of the counters, counting the tutors that
+        will register through a recurring rule later on
+        """
+        tutor_count = occupancy.tutors + RecurringPresence.pending_tutor_count(
+            occupancy.date, occupancy.pod
+        )
+        return Presence.capacity(special_date, tutor_count) - occupancy.members
+
+    @staticmethod
+    def slots_available(on_date, pod=None):
+        special_date = SpecialDate.get(on_date, pod)
+        occupancy = Occupancy.get(on_date, pod)
+
+        if pod:
+            return Presence.available_in(occupancy, special_date)
 
-        return slots_available - Presence.slots_taken(on_date, pod)
+        tutor_count = Presence.get_tutor_count(on_date)
+        return Presence.capacity(special_date, tutor_count) - occupancy.members
 
     @staticmethod
     def slots_taken(on_date, pod=None):
-        return Presence.objects.filter(
-            date=on_date, pod=pod, user__is_superuser=False
-        ).count()
+        return Occupancy.get(on_date, pod).members
 
     def __str__(self):
         return f"{self.date}/{self.pod}: {self.user}"
 
+    @classmethod
+    def from_db(cls, db, field_names, values, *args, **kwargs):
+        presence = super().from_db(db, field_names, values, *args, **kwargs)
+        loaded = presence.__dict__
+        if "seen" in loaded and "date" in loaded:
+            # Lets the signals tell whether the attendance changed on save
+            presence.counted_date = loaded["date"] if loaded["seen"] else None
+        if {"user_id", "date", "pod", "is_tutor"} <= loaded.keys():
+            # Lets the signals move the occupancy when the slot changed
+            presence.counted_user_id = loaded["user_id"]
+            presence.counted_slot = (loaded["date"], loaded["pod"], loaded["is_tutor"])
+        return presence
+
     SEEN_BY_CHOICES = (("mac", "Mac Adres"), ("manual", "Handmatig Aangemeld"))
 
-    user = models.ForeignKey(DjoUser, models.CASCADE)
+    # The unique index starts with the user
+    user = models.ForeignKey(DjoUser, models.CASCADE, db_index=False)
     date = models.DateField()
     pod = models.CharField(choices=POD_CHOICES, max_length=1, null=True)
     seen = models.BooleanField(default=False)
     seen_by = models.CharField(
         max_length=6, choices=SEEN_BY_CHOICES, default="manual", null=False
     )
+    # Whether the user was a tutor when registering, so counts need no join
+    # with the users. Set on the first save.
+    is_tutor = models.BooleanField(default=False, editable=False)
+
+    def save(self, *args, **kwargs):
+        if self._state.adding or self.user_id != getattr(
+            self, "counted_user_id", self.user_id
+        ):
+            self.is_tutor = self.user.is_superuser
+        super().save(*args, **kwargs)
+
+    @staticmethod
+    def history(user, since):
+        """The presences of the user since the date, including archived ones"""
+        fields = ("id", "date", "pod", "seen")
+        return list(
+            Presence.objects.filter(user=user, date__gte=since)
+            .values(*fields)
+            .union(
+                ArchivedPresence.objects.filter(user=user, date__gte=since).values(
+                    *fields
+                ),
+                all=True,
+            )
+            .order_by("date")
+        )
+
+    @staticmethod
+    def sync_tutor(user):
+        """
+        Move the upcoming presences of the user to the user's current role,
+        after it changed. Returns whether any presence was moved.
+        """
+        presences = Presence.objects.filter(
+            user=user, date__gte=datetime.date.today()
+        ).exclude(is_tutor=user.is_superuser)
+        keys = list(presences.values_list("date", "pod"))
+        if not keys:
+            return False
+
+        with transaction.atomic():
+            presences.update(is_tutor=user.is_superuser)
+            Occupancy.adjust_many(keys, user.is_superuser, 1)
+            Occupancy.adjust_many(keys, not user.is_superuser, -1)
+            StateVersion.bump()
+        return True
+
+
+class ArchivedPresence(models.Model):
+    """
+    Presences older than the archive horizon, moved out of Presence by the
+    archive_presences command so the table the registrations write to stays
+    small. History is read from both tables, see Presence.history().
+    """
+
+    class Meta:
+        indexes = [models.Index(fields=["user", "date"]), models.Index(fields=["date"])]
+
+    # Covered by the (user, date) index
+    user = models.ForeignKey(DjoUser, models.CASCADE, db_index=False)
+    date = models.DateField()
+    pod = models.CharField(choices=POD_CHOICES, max_length=1, null=True)
+    seen = models.BooleanField(default=False)
+    seen_by = models.CharField(
+        max_length=6, choices=Presence.SEEN_BY_CHOICES, default="manual", null=False
+    )
+    is_tutor = models.BooleanField(default=False)
+
+    def __str__(self):
+        return f"{self.date}/{self.pod}: {self.user} (archived)"
+
+    @staticmethod
+    def archive(before, batch_size):
+        """
+        Move one batch of the presences before the date to the archive.
+        Returns the number of presences that were moved.
+        """
+        fields = ["user_id", "date", "pod", "seen", "seen_by", "is_tutor"]
+        with transaction.atomic():
+            presences = list(
+                Presence.objects.filter(date__lt=before)
+                .order_by("date", "pk")
+                .values("pk", *fields)[:batch_size]
+            )
+            if not presences:
+                return 0
+
+            ArchivedPresence.objects.bulk_create(
+                [
+                    ArchivedPresence(**{field: row[field] for field in fields})
+                    for row in presences
+                ]
+            )
+            # Run through signals.archive_presences(), which keeps the
+            # Presence signals out of this
+            Presence.objects.filter(pk__in=[row["pk"] for row in presences]).delete()
+        return len(presences)
+
+
+class Occupancy(models.Model):
+    """
+    Denormalized member and tutor counts per (date, pod), kept up to date by
+    the Presence signals. Use the rebuild_occupancy command to fix drift.
+    """
+
+    class Meta:
+        unique_together = ("date", "pod")
+        verbose_name_plural = "Occupancies"
+
+    date = models.DateField()
+    pod = models.CharField(choices=POD_CHOICES, max_length=1, null=True)
+    members = models.IntegerField(default=0, null=False)
+    tutors = models.IntegerField(default=0, null=False)
+
+    def __str__(self):
+        return f"{self.date}/{self.pod}: {self.members} members, {self.tutors} tutors"
+
+    @staticmethod
+    def get(on_date, pod=None):
+        try:
+            return Occupancy.objects.get(date=on_date, pod=pod)
+        except Occupancy.DoesNotExist:
+            return Occupancy(date=on_date, pod=pod)
+
+    @staticmethod
+    def lock(on_date, pod):
+        """Get the counters for (date, pod), locked until the transaction ends"""
+        Occupancy.objects.get_or_create(date=on_date, pod=pod)
+        return Occupancy.objects.select_for_update().get(date=on_date, pod=pod)
+
+    @staticmethod
+    def adjust(on_date, pod, is_tutor, amount):
+        field = "tutors" if is_tutor else "members"
+        update = {field: models.F(field) + amount}
+        if Occupancy.objects.filter(date=on_date, pod=pod).update(**update):
+            return
+
+        occupancy, created = Occupancy.objects.get_or_create(
+            date=on_date, pod=pod, defaults={field: amount}
+        )
+        if not created:
+            # Created concurrently -> apply the change to that row
+            Occupancy.objects.filter(pk=occupancy.pk).update(**update)
+
+    @staticmethod
+    def adjust_many(keys, is_tutor, amount):
+        """adjust() for many (date, pod) at once, in two queries"""
+        if not keys:
+            return
+        Occupancy.objects.bulk_create(
+            [Occupancy(date=on_date, pod=pod) for on_date, pod in keys],
+            ignore_conflicts=True,
+        )
+        match = models.Q()
+        for on_date, pod in keys:
+            match |= models.Q(date=on_date, pod=pod)
+        field = "tutors" if is_tutor else "members"
+        Occupancy.objects.filter(match).update(**{field: models.F(field) + amount})
+
+    @staticmethod
+    def count_presences():
+        """Recount occupancy from Presence, as {(date, pod): (members, tutors)}"""
+        counts = {}
+        for row in (
+            Presence.objects.values("date", "pod", "is_tutor")
+            .annotate(count=models.Count("id"))
+            .order_by()
+        ):
+            members, tutors = counts.get((row["date"], row["pod"]), (0, 0))
+            if row["is_tutor"]:
+                tutors = row["count"]
+            else:
+                members = row["count"]
+            counts[(row["date"], row["pod"])] = (members, tutors)
+        return counts
+
+
+class Attendance(models.Model):
+    """
+    Denormalized number of presences a user was seen at per month, kept up to
+    date by the Presence signals and the bulk paths that skip them. Use the
+    rebuild_attendance command to fix drift.
+    """
+
+    class Meta:
+        unique_together = ("user", "month")
+
+    user = models.ForeignKey(DjoUser, models.CASCADE)
+    # First day of the month
+    month = models.DateField()
+    seen = models.IntegerField(default=0, null=False)
+
+    def __str__(self):
+        return f"{self.user} {self.month:%Y-%m}: {self.seen} times seen"
+
+    @staticmethod
+    def adjust(user_id, on_date, amount):
+        Attendance.adjust_many([(user_id, on_date)], amount)
+
+    @staticmethod
+    def adjust_many(keys, amount):
+        """adjust() for many (user, date) at once"""
+        if not keys:
+            return
+        months = collections.Counter(
+            (user_id, on_date.replace(day=1)) for user_id, on_date in keys
+        )
+        if amount > 0:
+            # Decrements only apply to rows that exist, also while the user
+            # is being deleted
+            Attendance.objects.bulk_create(
+                [Attendance(user_id=user_id, month=month) for user_id, month in months],
+                ignore_conflicts=True,
+            )
+        # One update per distinct count, a user is usually seen once per batch
+        matches = {}
+        for (user_id, month), count in months.items():
+            matches[count] = matches.get(count, models.Q()) | models.Q(
+                user=user_id, month=month
+            )
+        for count, match in matches.items():
+            Attendance.objects.filter(match).update(
+                seen=models.F("seen") + amount * count
+            )
+
+    @staticmethod
+    def count_since(username, from_date):
+        """
+        The number of presences the user was seen at since from_date. Whole
+        months come from the rollup, only the rest of the first month is
+        counted from Presence.
+        """
+        first_month = from_date.replace(day=1)
+        if first_month != from_date:
+            first_month = (first_month + datetime.timedelta(days=31)).replace(day=1)
+
+        count = Attendance.objects.filter(
+            user__username=username, month__gte=first_month
+        ).aggregate(seen=models.Sum("seen", default=0))["seen"]
+        if first_month != from_date:
+            head = {
+                "user__username": username,
+                "date__gte": from_date,
+                "date__lt": first_month,
+                "seen": True,
+            }
+            count += (
+                Presence.objects.filter(**head)
+                .values("pk")
+                .union(ArchivedPresence.objects.filter(**head).values("pk"), all=True)
+                .count()
+            )
+        return count
+
+    @staticmethod
+    def count_presences():
+        """
+        Recount attendance from Presence and ArchivedPresence, as
+        {(user, month): seen}
+        """
+        counts = collections.Counter()
+        for model in (Presence, ArchivedPresence):
+            for row in (
+                model.objects.filter(seen=True)
+                .annotate(month=TruncMonth("date"))
+                .values("user", "month")
+                .annotate(count=models.Count("id"))
+                .order_by()
+            ):
+                counts[(row["user"], row["month"])] += row["count"]
+        return dict(counts)
+
+
+class RecurringPresence(models.Model):
+    """
+    A standing registration of a tutor, e.g. every Friday evening until the
+    end of the season. It is expanded into Presence rows one window ahead at
+    a time (expanded_until). Dates after that are counted from the rule.
+    Dates the tutor deregistered from are skipped, see RecurringException.
+    """
+
+    class Meta:
+        unique_together = ("user", "name", "pod")
+
+    WINDOW = datetime.timedelta(weeks=2)
+
+    user = models.ForeignKey(DjoUser, models.CASCADE)
+    name = models.CharField(max_length=3, choices=DAY_CHOICES)
+    pod = models.CharField(choices=POD_CHOICES, max_length=1)
+    start = models.DateField(default=datetime.date.today)
+    until = models.DateField()
+    expanded_until = models.DateField(null=True, blank=True, editable=False)
+
+    def __str__(self):
+        return f"{self.user}: {self.name}-{self.pod} until {self.until}"
+
+    @classmethod
+    def from_db(cls, db, field_names, values, *args, **kwargs):
+        rule = super().from_db(db, field_names, values, *args, **kwargs)
+        loaded = rule.__dict__
+        if {"name", "pod", "until"} <= loaded.keys():
+            # Lets the signals tell whether the dates of the rule changed
+            rule.expanded_as = (loaded["name"], loaded["pod"], loaded["until"])
+        return rule
+
+    def dates(self, first, last):
+        """The dates of the rule between first and last"""
+        first = max(first, self.start)
+        first += datetime.timedelta((DAY_NUMBERS[self.name] - first.weekday()) % 7)
+        dates = []
+        while first <= min(last, self.until):
+            dates.append(first)
+            first += datetime.timedelta(weeks=1)
+        return dates
+
+    def expand(self):
+        """Create the presences of the rule up to the end of the window"""
+        today = datetime.date.today()
+        up_to = today + self.WINDOW
+        first = today
+        if self.expanded_until and self.expanded_until >= first:
+            first = self.expanded_until + datetime.timedelta(days=1)
+
+        with transaction.atomic():
+            DjoUser.lock(self.user_id)
+            dates = self.dates(first, up_to)
+            existing = set(
+                Presence.objects.filter(
+                    user=self.user_id, date__in=dates, pod=self.pod
+                ).values_list("date", flat=True)
+            )
+            existing.update(
+                self.exceptions.filter(date__in=dates).values_list("date", flat=True)
+            )
+            keys = [(day, self.pod) for day in dates if day not in existing]
+            if keys:
+                Presence.objects.bulk_create(
+                    [
+                        Presence(
+                            user_id=self.user_id,
+                            date=d,
+                            pod=p,
+                            is_tutor=self.user.is_superuser,
+                        )
+                        for d, p in keys
+                    ],
+                    ignore_conflicts=True,
+                )
+                # A bulk create sends no signals
+                Occupancy.adjust_many(keys, self.user.is_superuser, 1)
+                StateVersion.bump()
+
+            self.expanded_until = up_to
+            RecurringPresence.objects.filter(pk=self.pk).update(expanded_until=up_to)
+
+    @staticmethod
+    def expand_all():
+        """Expand the rules whose window is behind"""
+        today = datetime.date.today()
+        for rule in RecurringPresence.objects.filter(
+            models.Q(expanded_until__isnull=True)
+            | models.Q(expanded_until__lt=today + RecurringPresence.WINDOW),
+            until__gte=today,
+        ).select_related("user"):
+            rule.expand()
+
+    @staticmethod
+    def pending_tutors(dates):
+        """
+        First names of the tutors whose rules cover a date, but have not
+        been expanded up to it yet, per (date, pod)
+        """
+        if not dates:
+            return {}
+
+        candidates = []
+        for rule in (
+            RecurringPresence.objects.filter(
+                models.Q(expanded_until__isnull=True)
+                | models.Q(expanded_until__lt=max(dates)),
+                start__lte=max(dates),
+                until__gte=min(dates),
+                user__is_superuser=True,
+            )
+            .select_related("user")
+            .only("name", "pod", "start", "until", "expanded_until", "user__first_name")
+        ):
+            first = min(dates)
+            if rule.expanded_until:
+                first = max(first, rule.expanded_until + datetime.timedelta(days=1))
+            for day in rule.dates(first, max(dates)):
+                if day in dates:
+                    candidates.append((rule, day))
+        if not candidates:
+            return {}
+
+        # Tutors may already have registered for a date of their rule, or
+        # deregistered from it
+        registered = set(
+            Presence.objects.filter(
+                user__in={rule.user_id for rule, _ in candidates},
+                date__in={day for _, day in candidates},
+            ).values_list("user", "date", "pod")
+        )
+        skipped = set(
+            RecurringException.objects.filter(
+                rule__in={rule.pk for rule, _ in candidates},
+                date__in={day for _, day in candidates},
+            ).values_list("rule", "date")
+        )
+        pending = {}
+        for rule, day in candidates:
+            if (rule.user_id, day, rule.pod) in registered:
+                continue
+            if (rule.pk, day) in skipped:
+                continue
+            pending.setdefault((day, rule.pod), []).append(rule.user.first_name)
+        return pending
+
+    @staticmethod
+    def skipped_by(user, keys):
+        """
+        Exceptions that let the rules of the user skip the (date, pod) keys,
+        after the user deregistered from them. They still have to be saved.
+        """
+        if not keys:
+            return []
+        exceptions = []
+        for rule in RecurringPresence.objects.filter(
+            user=user,
+            pod__in={pod for _, pod in keys},
+            start__lte=max(day for day, _ in keys),
+            until__gte=min(day for day, _ in keys),
+        ):
+            for day, pod in keys:
+                if pod == rule.pod and rule.dates(day, day):
+                    exceptions.append(RecurringException(rule=rule, date=day))
+        return exceptions
+
+    @staticmethod
+    def pending_tutor_count(on_date, pod=None):
+        pending = RecurringPresence.pending_tutors([on_date])
+        return sum(
+            len(first_names)
+            for (_, rule_pod), first_names in pending.items()
+            if not pod or rule_pod == pod
+        )
+
+
+class RecurringException(models.Model):
+    """A date the tutor deregistered from, that the recurring rule skips"""
+
+    class Meta:
+        unique_together = ("rule", "date")
+
+    rule = models.ForeignKey(
+        RecurringPresence, models.CASCADE, related_name="exceptions"
+    )
+    date = models.DateField()
+
+    def __str__(self):
+        return f"{self.rule}: not on {self.date}"
+
+
+class StateVersion(models.Model):
+    """
+    Version of the registration state, bumped by the signals on every change
+    to Presence, SpecialDate and Slot. Stored as a single row.
+    """
+
+    version = models.BigIntegerField(default=0, null=False)
+
+    def __str__(self):
+        return f"State version {self.version}"
+
+    @staticmethod
+    def current():
+        return (
+            StateVersion.objects.filter(pk=1).values_list("version", flat=True).first()
+            or 0
+        )
+
+    @staticmethod
+    def bump():
+        update = {"version": models.F("version") + 1}
+        if not StateVersion.objects.filter(pk=1).update(**update):
+            _, created = StateVersion.objects.get_or_create(
+                pk=1, defaults={"version": 1}
+            )
+            if not created:
+                StateVersion.objects.filter(pk=1).update(**update)
 
 
 class SpecialDate(models.Model):
@@ -221,14 +806,27 @@ class SpecialDate(models.Model):
     closed = models.BooleanField()
 
     @staticmethod
-    def is_closed(on_date, pod=None):
+    def get(on_date, pod=None):
         try:
-            special_date = SpecialDate.objects.get(date=on_date, pod=pod)
+            return SpecialDate.objects.get(date=on_date, pod=pod)
         except SpecialDate.DoesNotExist:
-            try:
-                special_date = SpecialDate.objects.get(date=on_date, pod=None)
-            except SpecialDate.DoesNotExist:
-                special_date = None
+            pass
+        try:
+            return SpecialDate.objects.get(date=on_date, pod=None)
+        except SpecialDate.DoesNotExist:
+            return None
+
+    @staticmethod
+    def find(special_dates, on_date, pod=None):
+        """Same lookup as get(), on a dict keyed by (date, pod)"""
+        special_date = special_dates.get((on_date, pod))
+        if special_date is None:
+            special_date = special_dates.get((on_date, None))
+        return special_date
+
+    @staticmethod
+    def is_closed(on_date, pod=None):
+        special_date = SpecialDate.get(on_date, pod)
 
         closed = False
         if special_date:
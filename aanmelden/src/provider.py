@@ -0,0 +1,151 @@
+import json
+import logging
+import os
+import threading
+import time
+
+import jwt
+import requests
+
+logger = logging.getLogger(__name__)
+
+
+class ProviderMetadata:  # pylint: disable=too-many-instance-attributes
+    """
+    The OpenID configuration and signing keys of the IdP.
+
+    The metadata is fetched once and kept for `lifespan` seconds. If a cache
+    file is given, it is also written there, so a restarted process can verify
+    tokens without going to the network first. After start() a background
+    thread refreshes the metadata before it expires. A token signed with an
+    unknown key triggers a single refetch, shared by all threads that need it,
+    to pick up keys the IdP rotated in.
+    """
+
+    timeout = 10
+    # Tokens with made up key ids should not make us hammer the IdP
+    min_refetch_interval = 30
+
+    def __init__(self, url, cache_file=None, lifespan=3600):
+        self.url = url
+        self.cache_file = cache_file
+        self.lifespan = lifespan
+        self.configuration = None
+        self.jwks = None
+        self.keys = {}
+        self.fetched_at = 0
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        """Warm up the cache, then keep it fresh in the background"""
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.refresh_loop, daemon=True)
+            self.thread.start()
+
+        try:
+            self.ensure_loaded()
+        except (requests.RequestException, ValueError, jwt.PyJWTError):
+            # Try again on the first request
+            logger.exception("Loading the IdP metadata failed")
+
+    def refresh_loop(self):
+        while True:
+            time.sleep(max(self.fetched_at + self.lifespan * 0.8 - time.time(), 10))
+            try:
+                self.refresh()
+            except (requests.RequestException, ValueError, jwt.PyJWTError):
+                # Keep the current metadata, retry on the next round
+                logger.exception("Refreshing the IdP metadata failed")
+
+    def is_fresh(self):
+        return time.time() - self.fetched_at < self.lifespan
+
+    def ensure_loaded(self):
+        if self.configuration is not None and self.is_fresh():
+            return
+        with self.lock:
+            if self.configuration is None:
+                self.read_cache_file()
+            # Expired metadata is still used while the background thread
+            # fetches new metadata
+            if self.configuration is None or (
+                not self.is_fresh() and self.thread is None
+            ):
+                self.fetch()
+
+    def refresh(self):
+        with self.lock:
+            self.fetch()
+
+    def fetch(self):
+        configuration = requests.get(self.url, timeout=self.timeout).json()
+        jwks = requests.get(configuration["jwks_uri"], timeout=self.timeout).json()
+        self.update(configuration, jwks, time.time())
+        self.write_cache_file()
+
+    def update(self, configuration, jwks, fetched_at):
+        self.keys = {key.key_id: key for key in jwt.PyJWKSet.from_dict(jwks).keys}
+        self.configuration = configuration
+        self.jwks = jwks
+        self.fetched_at = fetched_at
+
+    def read_cache_file(self):
+        if not self.cache_file:
+            return
+        try:
+            with open(self.cache_file, encoding="utf-8") as f:
+                cached = json.load(f)
+            self.update(cached["configuration"], cached["jwks"], cached["fetched_at"])
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError, jwt.PyJWTError):
+            logger.exception("Ignoring invalid IdP metadata cache file")
+
+    def write_cache_file(self):
+        if not self.cache_file:
+            return
+        # Write and rename, so other processes never read a partial file
+        temp_file = f"{self.cache_file}.{os.getpid()}"
+        try:
+            with open(temp_file, "w", encoding="utf-8") as f:
+                json.dump(
+                    {
+                        "configuration": self.configuration,
+                        "jwks": self.jwks,
+                        "fetched_at": self.fetched_at,
+                    },
+                    f,
+                )
+            os.replace(temp_file, self.cache_file)
+        except OSError:
+            logger.exception("Writing the IdP metadata cache file failed")
+
+    def get_openid_configuration(self):
+        self.ensure_loaded()
+        return self.configuration
+
+    def get_signing_key(self, kid):
+        self.ensure_loaded()
+        if kid in self.keys:
+            return self.keys[kid]
+
+        fetched_at = self.fetched_at
+        with self.lock:
+            # Only the first thread to get here refetches, the others find
+            # the keys it fetched
+            if (
+                self.fetched_at == fetched_at
+                and kid not in self.keys
+                and time.time() - self.fetched_at >= self.min_refetch_interval
+            ):
+                self.fetch()
+        if kid in self.keys:
+            return self.keys[kid]
+        raise jwt.PyJWKClientError(
+            f'Unable to find a signing key that matches: "{kid}"'
+        )
+
+    def get_signing_key_from_jwt(self, token):
+        # Same interface as jwt.PyJWKClient
+        return self.get_signing_key(jwt.get_unverified_header(token).get("kid"))
@@ -0,0 +1,188 @@
+import contextlib
+import contextvars
+
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from aanmelden.src import updates
+from aanmelden.src.macindex import mac_index
+from aanmelden.src.models import (
+    ArchivedPresence,
+    Attendance,
+    DjangoUser,
+    DjoUser,
+    MacAddress,
+    Occupancy,
+    Presence,
+    RecurringException,
+    RecurringPresence,
+    Slot,
+    SpecialDate,
+    StateVersion,
+    UserInfo,
+)
+
+SHOWN_USER_FIELDS = {
+    "first_name",
+    "last_name",
+    "is_superuser",
+    "account_type",
+    "stripcard_used",
+    "stripcard_count",
+}
+
+_presence_signals_suppressed = contextvars.ContextVar(
+    "presence_signals_suppressed", default=False
+)
+
+
+@contextlib.contextmanager
+def presence_signals_suppressed():
+    """
+    Skip the Presence signals in this block, for callers that apply their
+    side effects for many rows at once or not at all
+    """
+    token = _presence_signals_suppressed.set(True)
+    try:
+        yield
+    finally:
+        _presence_signals_suppressed.reset(token)
+
+
+@receiver(post_save, sender=Presence)
+def presence_saved(instance, created, **kwargs):
+    if _presence_signals_suppressed.get():
+        return
+    counted_user_id = getattr(instance, "counted_user_id", instance.user_id)
+    counted_slot = getattr(instance, "counted_slot", None)
+    slot = (instance.date, instance.pod, instance.is_tutor)
+    if created:
+        Occupancy.adjust(*slot, 1)
+        updates.presence_added(instance)
+    elif counted_slot and (counted_user_id, counted_slot) != (instance.user_id, slot):
+        # Moved to another slot or user, e.g. in the admin
+        Occupancy.adjust(*counted_slot, -1)
+        Occupancy.adjust(*slot, 1)
+        mac_index.mark_unseen(counted_user_id, counted_slot[0])
+        moved_from = Presence(pk=instance.pk, date=counted_slot[0], pod=counted_slot[1])
+        updates.presence_removed(moved_from)
+        updates.presence_added(instance)
+    else:
+        updates.presence_changed(instance)
+    instance.counted_user_id = instance.user_id
+    instance.counted_slot = slot
+    if not instance.seen:
+        # A device that joins again should mark the user as seen again
+        mac_index.mark_unseen(instance.user_id, instance.date)
+    # Unknown for instances that were not loaded from the database
+    counted_date = getattr(instance, "counted_date", None if created else False)
+    if counted_date is not False:
+        attendance_changed(instance, counted_user_id, counted_date)
+    # The saved row is what the next save of this instance is compared to
+    instance.counted_date = instance.date if instance.seen else None
+    StateVersion.bump()
+
+
+def attendance_changed(instance, counted_user_id, counted_date):
+    new_counted_date = instance.date if instance.seen else None
+    if (counted_user_id, counted_date) != (instance.user_id, new_counted_date):
+        if counted_date:
+            Attendance.adjust(counted_user_id, counted_date, -1)
+        if new_counted_date:
+            Attendance.adjust(instance.user_id, new_counted_date, 1)
+
+
+@receiver(post_delete, sender=Presence)
+def presence_deleted(instance, **kwargs):
+    if _presence_signals_suppressed.get():
+        return
+    presences_removed([instance])
+
+
+def presences_removed(presences):
+    """Update the counters, the MAC index and the pages for removed presences"""
+    if len(presences) == 1:
+        Occupancy.adjust(presences[0].date, presences[0].pod, presences[0].is_tutor, -1)
+    else:
+        for is_tutor in (False, True):
+            Occupancy.adjust_many(
+                [(p.date, p.pod) for p in presences if p.is_tutor == is_tutor],
+                is_tutor,
+                -1,
+            )
+    Attendance.adjust_many([(p.user_id, p.date) for p in presences if p.seen], -1)
+    for presence in presences:
+        mac_index.mark_unseen(presence.user_id, presence.date)
+    updates.presences_removed(presences)
+    StateVersion.bump()
+
+
+def delete_presences(presences):
+    """Delete many presences, with presences_removed() run once for all of them"""
+    with presence_signals_suppressed():
+        Presence.objects.filter(pk__in=[presence.pk for presence in presences]).delete()
+    presences_removed(presences)
+
+
+def archive_presences(before, batch_size):
+    """
+    ArchivedPresence.archive() with the Presence signals suppressed. Archiving
+    is not a deregistration: Attendance keeps counting the archived rows, and
+    the Occupancy counters of archived dates are dropped by the
+    archive_presences command. Past dates are not on any page.
+    """
+    with presence_signals_suppressed():
+        return ArchivedPresence.archive(before, batch_size)
+
+
+@receiver(post_save, sender=RecurringPresence)
+def recurring_presence_saved(instance, **kwargs):
+    dates = (instance.name, instance.pod, instance.until)
+    if getattr(instance, "expanded_as", None) != dates:
+        # The rule moved to other dates, expand the whole window again
+        instance.expanded_until = None
+    instance.expanded_as = dates
+    instance.expand()
+
+
+@receiver(post_save, sender=RecurringPresence)
+@receiver(post_delete, sender=RecurringPresence)
+@receiver(post_save, sender=RecurringException)
+@receiver(post_delete, sender=RecurringException)
+@receiver(post_save, sender=Slot)
+@receiver(post_delete, sender=Slot)
+@receiver(post_save, sender=SpecialDate)
+@receiver(post_delete, sender=SpecialDate)
+def slots_changed(**kwargs):
+    updates.slots_changed()
+    StateVersion.bump()
+
+
+@receiver(post_save, sender=DjangoUser)
+@receiver(post_save, sender=DjoUser)
+@receiver(post_save, sender=UserInfo)
+def user_changed(update_fields=None, **kwargs):
+    # Names, roles and stripcards are part of the slot lists. Logging in only
+    # touches last_login, and sync_user() only saves the changed fields.
+    if update_fields and not SHOWN_USER_FIELDS.intersection(update_fields):
+        return
+    StateVersion.bump()
+
+
+@receiver(post_save, sender=DjangoUser)
+@receiver(post_save, sender=DjoUser)
+def user_role_changed(instance, created, update_fields=None, **kwargs):
+    if created or (update_fields and "is_superuser" not in update_fields):
+        return
+    if Presence.sync_tutor(instance):
+        updates.slots_changed()
+
+
+@receiver(post_save, sender=MacAddress)
+def mac_address_saved(instance, **kwargs):
+    mac_index.mac_saved(instance)
+
+
+@receiver(post_delete, sender=MacAddress)
+def mac_address_deleted(instance, **kwargs):
+    mac_index.mac_deleted(instance)
@@ -1,10 +1,45 @@
+import asyncio
 import datetime
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
+from unittest.mock import patch
 
+import jwt
+import requests
+from asgiref.sync import async_to_sync
+from cryptography.hazmat.primitives.asymmetric import rsa
 from django.contrib.auth import get_user_model
-from django.test import TestCase, Client
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db.models import Sum
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, Client
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 
-from aanmelden.src.models import Slot, UserInfo, Presence
+from aanmelden.sockets import BroadcastBus, UnixSocketManager
+from aanmelden.src import updates
+from aanmelden.src.freeslots import FreeSlotsCache
+from aanmelden.src.introspection import IntrospectionClient
+from aanmelden.src.provider import ProviderMetadata
+from aanmelden.src.models import (
+    ArchivedPresence,
+    Attendance,
+    Slot,
+    UserInfo,
+    Presence,
+    SpecialDate,
+    Occupancy,
+    StateVersion,
+)
+from aanmelden.src.signals import archive_presences
+from aanmelden.src.utils import register, deregister, mark_seen
 
 DjoUser = get_user_model()
 
@@ -36,6 +71,23 @@ class ViewsTestCase(TestCase):
             name=day_name, pod="m", description="Test Slot", enabled=True  # Ochtend
         )
 
+    @patch("aanmelden.src.views.OAuth2Session")
+    def test_login_keeps_state_version(self, mock_session):
+        oauth = mock_session.return_value
+        oauth.fetch_token.return_value = {"access_token": "token"}
+        oauth.get.return_value.json.return_value = {
+            "id": 1,
+            "email": "user@example.com",
+            "firstName": "",
+            "lastName": "",
+            "accountType": "lid",
+            "days": 3,
+        }
+        version = StateVersion.current()
+        response = self.client.get("/oauth/callback")
+        self.assertEqual(response.url, reverse("main"))
+        self.assertEqual(StateVersion.current(), version)
+
     def test_main_view_requires_login(self):
         response = self.client.get(reverse("main"))
         self.assertEqual(response.status_code, 302)
@@ -90,6 +142,34 @@ class ViewsTestCase(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertTemplateUsed(response, "report.html")
 
+    def test_report_presences_are_grouped(self):
+        other = Slot.objects.create(name=self.slot.name, pod="e", description="")
+        today = datetime.date.today()
+        Presence.objects.create(user=self.user, date=today, pod="m")
+        Presence.objects.create(user=self.superuser, date=today, pod="m")
+        self.client.force_login(self.superuser)
+
+        def get_report():
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(reverse("report"))
+            return response, len(queries)
+
+        response, few = get_report()
+        slots = {slot["pod"]: slot for slot in response.context["slots"]}
+        # Tutors first
+        self.assertEqual(
+            [presence.user for presence in slots["m"]["presences"]],
+            [self.superuser, self.user],
+        )
+        self.assertEqual(slots["e"]["presences"], [])
+
+        for i in range(5):
+            user = DjoUser.objects.create_user(username=f"idp-1{i}")
+            UserInfo.objects.create(user=user, days=1)
+            Presence.objects.create(user=user, date=today, pod=other.pod)
+        _, many = get_report()
+        self.assertEqual(few, many)
+
     def test_calendar_view_begeleider(self):
         self.client.force_login(self.superuser)
         response = self.client.get(reverse("calendar"))
@@ -125,3 +205,715 @@ class ViewsTestCase(TestCase):
         self.assertTrue(
             Presence.objects.filter(user=self.user, pod=self.slot.pod).exists()
         )
+
+
+class SlotSnapshotTestCase(TestCase):
+    def setUp(self):
+        self.user = DjoUser.objects.create_user(username="idp-1", first_name="Lid")
+        self.tutor = DjoUser.objects.create_superuser(
+            username="idp-2", first_name="Begeleider"
+        )
+        today = datetime.date.today()
+        self.slots = [
+            Slot.objects.create(
+                name=today.strftime("%a").lower(), pod=pod, description=pod
+            )
+            for pod in ("m", "a", "e")
+        ]
+        Presence.objects.create(user=self.user, date=today, pod="m")
+        Presence.objects.create(user=self.tutor, date=today, pod="m")
+        SpecialDate.objects.create(
+            date=today, pod="a", free_slots=3, closed=False, announcement="Hoi"
+        )
+        SpecialDate.objects.create(date=today, free_slots=-1, closed=True)
+
+    def test_matches_slot_properties(self):
+        snapshot = Slot.get_enabled_slots(self.user)
+        self.assertEqual(len(snapshot), 3)
+        for slot, available_slot in zip(self.slots, snapshot):
+            self.assertEqual(available_slot["name"], slot.name)
+            self.assertEqual(available_slot["date"], slot.date)
+            self.assertEqual(available_slot["taken"], slot.taken)
+            self.assertEqual(available_slot["available"], slot.available)
+            self.assertEqual(available_slot["closed"], slot.closed)
+            self.assertEqual(available_slot["tutor_count"], slot.tutor_count)
+            self.assertEqual(available_slot["tutors"], slot.tutors)
+            self.assertEqual(available_slot["announcement"], slot.announcement)
+            self.assertEqual(
+                available_slot["is_registered"], slot.is_registered(self.user)
+            )
+
+    def test_fixed_query_count(self):
+        with self.assertNumQueries(6):
+            Slot.get_enabled_slots(self.user)
+
+        for pod in ("m", "a", "e"):
+            other = DjoUser.objects.create_user(username=f"idp-{pod}")
+            Presence.objects.create(user=other, date=self.slots[0].date, pod=pod)
+
+        with self.assertNumQueries(6):
+            Slot.get_enabled_slots(self.user)
+        with self.assertNumQueries(5):
+            Slot.get_enabled_slots()
+
+
+class OccupancyTestCase(TestCase):
+    def setUp(self):
+        self.user = DjoUser.objects.create_user(username="idp-1")
+        UserInfo.objects.create(user=self.user, days=1)
+        self.tutor = DjoUser.objects.create_superuser(username="idp-2")
+        today = datetime.date.today()
+        self.slot = Slot.objects.create(
+            name=today.strftime("%a").lower(), pod="m", description="Test Slot"
+        )
+
+    def test_counts_follow_registrations(self):
+        register(self.slot, self.user)
+        register(self.slot, self.tutor, skip_checks=True)
+        occupancy = Occupancy.objects.get(date=self.slot.date, pod=self.slot.pod)
+        self.assertEqual((occupancy.members, occupancy.tutors), (1, 1))
+
+        deregister(self.slot, self.user)
+        occupancy.refresh_from_db()
+        self.assertEqual((occupancy.members, occupancy.tutors), (0, 1))
+
+    def test_role_change_moves_presences(self):
+        presence = register(self.slot, self.tutor, skip_checks=True)
+        self.assertTrue(presence.is_tutor)
+
+        self.tutor.is_superuser = False
+        self.tutor.save(update_fields=["is_superuser"])
+        presence.refresh_from_db()
+        self.assertFalse(presence.is_tutor)
+        occupancy = Occupancy.objects.get(date=self.slot.date, pod=self.slot.pod)
+        self.assertEqual((occupancy.members, occupancy.tutors), (1, 0))
+
+        # Deregistering uses the recorded role
+        deregister(self.slot, self.tutor)
+        occupancy.refresh_from_db()
+        self.assertEqual((occupancy.members, occupancy.tutors), (0, 0))
+
+    def test_moved_presence_moves_counts(self):
+        presence = register(self.slot, self.user)
+        evening = Slot.objects.create(
+            name=self.slot.name, pod="e", description="Test Slot"
+        )
+
+        presence = Presence.objects.get(pk=presence.pk)
+        presence.pod = "e"
+        presence.save()
+        self.assertEqual(Presence.slots_taken(self.slot.date, "m"), 0)
+        self.assertEqual(Presence.slots_taken(evening.date, "e"), 1)
+
+        # Moving to a tutor changes the role the presence is counted as
+        presence.user = self.tutor
+        presence.save()
+        self.assertTrue(presence.is_tutor)
+        occupancy = Occupancy.objects.get(date=evening.date, pod="e")
+        self.assertEqual((occupancy.members, occupancy.tutors), (0, 1))
+
+        check = StringIO()
+        call_command("rebuild_occupancy", check=True, stdout=check)
+        self.assertIn("No drift found", check.getvalue())
+
+    def test_available_reads_counters_not_presences(self):
+        register(self.slot, self.user)
+        # Special dates, the counters and the recurring rules
+        with CaptureQueriesContext(connection) as queries:
+            available = Presence.slots_available(self.slot.date, self.slot.pod)
+        self.assertEqual(available, 15)
+        self.assertEqual(len(queries), 4)
+        self.assertFalse(any('"src_presence"' in query["sql"] for query in queries))
+
+    def test_rebuild_fixes_drift(self):
+        register(self.slot, self.user)
+        Occupancy.objects.update(members=5)
+
+        with self.assertRaisesMessage(CommandError, "Found 1 drifted"):
+            call_command("rebuild_occupancy", check=True, stdout=StringIO())
+
+        call_command("rebuild_occupancy", stdout=StringIO())
+        occupancy = Occupancy.objects.get(date=self.slot.date, pod=self.slot.pod)
+        self.assertEqual(occupancy.members, 1)
+
+        out = StringIO()
+        call_command("rebuild_occupancy", check=True, stdout=out)
+        self.assertIn("No drift found", out.getvalue())
+
+
+class BenchmarkPresenceTestCase(TestCase):
+    def test_benchmark_leaves_no_rows(self):
+        out = StringIO()
+        call_command("benchmark_presence", count=50, stdout=out)
+        self.assertIn("50 inserts in", out.getvalue())
+        self.assertIn("Presences of a slot:", out.getvalue())
+        self.assertFalse(Presence.objects.exists())
+        self.assertFalse(DjoUser.objects.exists())
+
+
+class AttendanceTestCase(TestCase):
+    def setUp(self):
+        self.user = DjoUser.objects.create_user(username="idp-1")
+        UserInfo.objects.create(user=self.user, days=1)
+        self.today = datetime.date.today()
+        self.slot = Slot.objects.create(
+            name=self.today.strftime("%a").lower(), pod="m", description="Test Slot"
+        )
+
+    def seen(self):
+        return Attendance.objects.filter(user=self.user).aggregate(
+            seen=Sum("seen", default=0)
+        )["seen"]
+
+    def test_counts_follow_seen(self):
+        presence = register(self.slot, self.user)
+        self.assertEqual(self.seen(), 0)
+
+        mark_seen(presence.pk, "true")
+        mark_seen(presence.pk, "true")
+        self.assertEqual(self.seen(), 1)
+        mark_seen(presence.pk, "false")
+        self.assertEqual(self.seen(), 0)
+
+        mark_seen(presence.pk, "true")
+        Presence.objects.get(pk=presence.pk).delete()
+        self.assertEqual(self.seen(), 0)
+
+        # The created instance itself is saved again
+        presence = Presence.objects.create(user=self.user, date=self.today, pod="m")
+        presence.seen = True
+        presence.save()
+        self.assertEqual(self.seen(), 1)
+        presence.save()
+        self.assertEqual(self.seen(), 1)
+
+    def test_count_since(self):
+        # Seen every week for a year and a half
+        for week in range(80):
+            Presence.objects.create(
+                user=self.user,
+                date=self.today - datetime.timedelta(weeks=week),
+                pod="m",
+                seen=week % 3 != 0,
+            )
+
+        for days in (0, 1, 30, 45, 200, 365, 600):
+            from_date = self.today - datetime.timedelta(days=days)
+            with self.assertNumQueries(2 if from_date.day != 1 else 1):
+                count = Attendance.count_since(self.user.username, from_date)
+            self.assertEqual(
+                count,
+                Presence.objects.filter(
+                    user=self.user, date__gte=from_date, seen=True
+                ).count(),
+            )
+
+    def test_rebuild_fixes_drift(self):
+        Presence.objects.create(user=self.user, date=self.today, pod="m", seen=True)
+        Attendance.objects.update(seen=5)
+
+        with self.assertRaisesMessage(CommandError, "Found 1 drifted"):
+            call_command("rebuild_attendance", check=True, stdout=StringIO())
+
+        call_command("rebuild_attendance", stdout=StringIO())
+        self.assertEqual(self.seen(), 1)
+
+        out = StringIO()
+        call_command("rebuild_attendance", check=True, stdout=out)
+        self.assertIn("No drift found", out.getvalue())
+
+
+class ArchiveTestCase(TestCase):
+    def setUp(self):
+        self.user = DjoUser.objects.create_user(username="idp-1")
+        self.today = datetime.date.today()
+        self.old = self.today - datetime.timedelta(days=400)
+        for days in range(0, 14, 7):
+            Presence.objects.create(
+                user=self.user,
+                date=self.old + datetime.timedelta(days=days),
+                pod="e",
+                seen=True,
+            )
+        Presence.objects.create(user=self.user, date=self.today, pod="e", seen=True)
+
+    def test_old_presences_are_archived(self):
+        out = StringIO()
+        call_command("archive_presences", days=365, batch_size=1, stdout=out)
+        self.assertIn("Archived 2 presences", out.getvalue())
+        self.assertEqual(
+            list(Presence.objects.values_list("date", flat=True)), [self.today]
+        )
+        self.assertEqual(ArchivedPresence.objects.count(), 2)
+        self.assertFalse(Occupancy.objects.filter(date__lt=self.today).exists())
+
+        # History covers both tables
+        self.assertEqual(
+            [entry["date"] for entry in Presence.history(self.user, self.old)],
+            [self.old, self.old + datetime.timedelta(days=7), self.today],
+        )
+        self.assertEqual(Attendance.count_since("idp-1", self.old), 3)
+        self.assertEqual(
+            Attendance.count_since("idp-1", self.old + datetime.timedelta(days=1)), 2
+        )
+
+        check = StringIO()
+        call_command("rebuild_attendance", check=True, stdout=check)
+        call_command("rebuild_occupancy", check=True, stdout=check)
+        self.assertEqual(check.getvalue().count("No drift found"), 2)
+
+    def test_recent_presences_are_kept(self):
+        with self.assertRaises(CommandError):
+            call_command("archive_presences", days=7)
+        call_command("archive_presences", days=500, stdout=StringIO())
+        self.assertEqual(Presence.objects.count(), 3)
+
+
+class ExportTestCase(TestCase):
+    def setUp(self):
+        self.user = DjoUser.objects.create_user(username="idp-1", first_name="Test")
+        self.tutor = DjoUser.objects.create_superuser(username="idp-2")
+        self.dates = [
+            datetime.date(2024, 1, 31) + datetime.timedelta(days=d)
+            for d in (0, 1, 29, 30, 60)
+        ]
+        for day in self.dates:
+            Presence.objects.create(user=self.user, date=day, pod="e", seen=True)
+        # Archive the first two
+        archive_presences(self.dates[2], 100)
+
+    def test_command_exports_range(self):
+        out = StringIO()
+        call_command(
+            "export_presences",
+            "2024-01-31",
+            until="2024-03-01",
+            format="ndjson",
+            stdout=out,
+        )
+        rows = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(
+            [row["date"] for row in rows],
+            [day.isoformat() for day in self.dates[:4]],
+        )
+        self.assertEqual(
+            rows[0],
+            {
+                "date": "2024-01-31",
+                "pod": "e",
+                "username": "idp-1",
+                "first_name": "Test",
+                "last_name": "",
+                "is_tutor": False,
+                "seen": True,
+                "seen_by": "manual",
+            },
+        )
+
+    def test_view_streams_csv(self):
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(reverse("export")).status_code, 403)
+
+        self.client.force_login(self.tutor)
+        self.assertEqual(self.client.get(reverse("export")).status_code, 400)
+        for until in ("foo", "2024-02-30"):
+            response = self.client.get(
+                reverse("export"), {"from": "2024-02-01", "until": until}
+            )
+            self.assertEqual(response.status_code, 400)
+        response = self.client.get(reverse("export"), {"from": "2024-02-01"})
+        self.assertTrue(response.streaming)
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(
+            lines[0], "date,pod,username,first_name,last_name,is_tutor,seen,seen_by"
+        )
+        self.assertEqual(len(lines), 1 + 4)
+
+    async def test_view_streams_under_asgi(self):
+        await self.async_client.aforce_login(self.tutor)
+        response = await self.async_client.get(
+            reverse("export"), {"from": "2024-02-01", "format": "ndjson"}
+        )
+        self.assertTrue(response.is_async)
+        lines = b"".join([part async for part in response.streaming_content])
+        self.assertEqual(len(lines.splitlines()), 4)
+
+
+class BroadcastBusTestCase(SimpleTestCase):
+    class FakeServer:
+        def __init__(self):
+            self.emitted = []
+
+        async def emit(self, event, data=None, to=None):
+            self.emitted.append((event, data, to))
+
+    def setUp(self):
+        self.server = self.FakeServer()
+        self.bus = BroadcastBus(
+            self.server, window=0.05, build=lambda event, changes: [("room", changes)]
+        )
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.bus.start(), self.loop).result()
+
+    def tearDown(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def test_notify_without_server_is_ignored(self):
+        BroadcastBus(self.server).notify("update_main_page")
+        self.assertEqual(self.server.emitted, [])
+
+    def test_bursts_are_coalesced(self):
+        for i in range(30):
+            self.bus.notify("update_report_page", added=[i])
+            self.bus.notify("update_main_page", slots=[i % 2])
+        self.bus.notify("update_report_page", removed=[0])
+        self.assertEqual(self.server.emitted, [])
+
+        time.sleep(0.2)
+        self.assertEqual(
+            self.server.emitted,
+            [
+                ("update_main_page", {"slots": [0, 1] * 15}, "room"),
+                (
+                    "update_report_page",
+                    {"added": list(range(30)), "removed": [0]},
+                    "room",
+                ),
+            ],
+        )
+
+        self.bus.notify("update_report_page")
+        time.sleep(0.2)
+        self.assertEqual(self.server.emitted[2:], [("update_report_page", {}, "room")])
+
+    def test_skipped_when_nothing_to_send(self):
+        self.bus.build = lambda event, changes: []
+        self.bus.notify("update_main_page", slots=[1])
+        time.sleep(0.2)
+        self.assertEqual(self.server.emitted, [])
+
+
+class UnixSocketManagerTestCase(SimpleTestCase):
+    # pylint: disable=protected-access
+    def setUp(self):
+        # pylint: disable-next=consider-using-with
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = directory.name
+
+    def test_publish_reaches_other_processes(self):
+        sender = UnixSocketManager(self.path)
+        receiver = UnixSocketManager(self.path)
+
+        async def exchange():
+            messages = receiver._listen()
+            received = asyncio.ensure_future(anext(messages))
+            await asyncio.sleep(0)
+            await sender._publish({"method": "emit", "room": "main"})
+            message = await asyncio.wait_for(received, 1)
+            await messages.aclose()
+            return message
+
+        self.assertEqual(
+            json.loads(asyncio.run(exchange())), {"method": "emit", "room": "main"}
+        )
+        # The receiver removes its socket when it stops listening
+        self.assertEqual(os.listdir(self.path), [])
+
+    def test_stale_peers_are_removed(self):
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        stale.bind(os.path.join(self.path, "socketio-gone.sock"))
+        stale.close()
+
+        asyncio.run(UnixSocketManager(self.path)._publish({"method": "emit"}))
+        self.assertEqual(os.listdir(self.path), [])
+
+
+class StubIdP(ThreadingHTTPServer):
+    """Serves an OpenID configuration and the public keys of its signing keys"""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):  # pylint: disable=invalid-name
+            self.server.requests.append(self.path)
+            if self.path == "/.well-known/openid-configuration":
+                body = {
+                    "jwks_uri": f"{self.server.url}/jwks",
+                    "id_token_signing_alg_values_supported": ["RS256"],
+                }
+            else:
+                keys = []
+                for kid, key in self.server.keys.items():
+                    jwk = jwt.algorithms.RSAAlgorithm.to_jwk(
+                        key.public_key(), as_dict=True
+                    )
+                    keys.append({**jwk, "kid": kid, "use": "sig"})
+                body = {"keys": keys}
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.end_headers()
+            self.wfile.write(json.dumps(body).encode())
+
+        def log_message(self, *args):  # pylint: disable=arguments-differ
+            pass
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), self.Handler)
+        self.url = f"http://127.0.0.1:{self.server_port}"
+        self.requests = []
+        self.keys = {}
+        self.rotate("one")
+
+    def rotate(self, kid):
+        self.keys[kid] = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+    def token(self, kid):
+        return jwt.encode({"sub": "1"}, self.keys[kid], "RS256", headers={"kid": kid})
+
+
+class ProviderMetadataTestCase(SimpleTestCase):
+    def setUp(self):
+        self.idp = StubIdP()
+        threading.Thread(target=self.idp.serve_forever, daemon=True).start()
+        self.addCleanup(self.idp.server_close)
+        self.addCleanup(self.idp.shutdown)
+        # pylint: disable-next=consider-using-with
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.cache_file = os.path.join(directory.name, "openid-cache.json")
+
+    def provider(self, **kwargs):
+        return ProviderMetadata(
+            f"{self.idp.url}/.well-known/openid-configuration",
+            cache_file=self.cache_file,
+            **kwargs,
+        )
+
+    def decode(self, provider, token):
+        key = provider.get_signing_key_from_jwt(token)
+        return jwt.decode(token, key=key.key, algorithms=["RS256"])
+
+    def test_cold_start_from_cache_file(self):
+        self.assertEqual(
+            self.decode(self.provider(), self.idp.token("one")), {"sub": "1"}
+        )
+        self.assertEqual(len(self.idp.requests), 2)
+
+        # A new process reads the keys from disk
+        provider = self.provider()
+        self.assertEqual(self.decode(provider, self.idp.token("one")), {"sub": "1"})
+        self.assertEqual(
+            provider.get_openid_configuration()["jwks_uri"], f"{self.idp.url}/jwks"
+        )
+        self.assertEqual(len(self.idp.requests), 2)
+
+    def test_expired_metadata_is_refetched(self):
+        provider = self.provider(lifespan=0)
+        provider.get_openid_configuration()
+        provider.get_openid_configuration()
+        self.assertEqual(len(self.idp.requests), 4)
+
+    def test_unknown_key_is_fetched_once(self):
+        provider = self.provider()
+        provider.min_refetch_interval = 0
+        provider.get_openid_configuration()
+        self.idp.rotate("two")
+        token = self.idp.token("two")
+
+        threads = [
+            threading.Thread(target=self.decode, args=(provider, token))
+            for _ in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.decode(provider, token), {"sub": "1"})
+        self.assertEqual(len(self.idp.requests), 4)
+
+        with self.assertRaises(jwt.PyJWKClientError):
+            provider.get_signing_key("three")
+        self.assertEqual(len(self.idp.requests), 6)
+
+    def test_unknown_keys_are_rate_limited(self):
+        provider = self.provider()
+        provider.get_openid_configuration()
+        with self.assertRaises(jwt.PyJWKClientError):
+            provider.get_signing_key("three")
+        self.assertEqual(len(self.idp.requests), 2)
+
+
+class IntrospectionClientTestCase(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = IntrospectionClient()
+        self.calls = 0
+
+    def fetch(self, token):
+        self.calls += 1
+        time.sleep(0.1)
+        return {"active": True, "client_id": token, "exp": time.time() + 60}
+
+    def test_concurrent_lookups_share_one_call(self):
+        results = []
+        with patch.object(self.client, "fetch", self.fetch):
+            threads = [
+                threading.Thread(
+                    target=lambda: results.append(self.client.introspect("corvee"))
+                )
+                for _ in range(8)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.client.introspect("corvee")
+
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(len(results), 8)
+        self.assertTrue(all(result["client_id"] == "corvee" for result in results))
+
+    def test_waiting_times_out(self):
+        self.client.timeout = 0.01
+        leader = threading.Thread(target=self.client.introspect, args=("corvee",))
+        with patch.object(self.client, "fetch", self.fetch):
+            leader.start()
+            while not self.client.calls:
+                time.sleep(0.001)
+            with self.assertLogs("aanmelden.src.introspection", "WARNING"):
+                self.assertEqual(self.client.introspect("corvee"), {"active": False})
+            leader.join()
+
+    def test_cached_until_expiry(self):
+        self.assertEqual(self.client.cache_timeout({"active": False}), 1800)
+        timeout = self.client.cache_timeout({"active": True, "exp": time.time() + 60.5})
+        self.assertEqual(timeout, 60)
+
+    def test_errors_are_not_cached(self):
+        with patch.object(
+            self.client, "fetch", side_effect=requests.ConnectionError
+        ) as fetch:
+            self.assertEqual(self.client.introspect("corvee"), {"active": False})
+            self.assertEqual(self.client.introspect("corvee"), {"active": False})
+        self.assertEqual(fetch.call_count, 2)
+
+
+class FreeSlotsCacheTestCase(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.cache = FreeSlotsCache()
+        self.builds = 0
+
+    def build(self):
+        self.builds += 1
+        time.sleep(0.1)
+        return f"build {self.builds}".encode()
+
+    def test_concurrent_misses_share_one_build(self):
+        results = []
+        with patch.object(self.cache, "build", self.build):
+            threads = [
+                threading.Thread(
+                    target=lambda: results.append(self.cache.get_body("1-today"))
+                )
+                for _ in range(8)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(self.cache.get_body("1-today"), b"build 1")
+            self.assertEqual(self.builds, 1)
+
+            # A new version replaces the cached body
+            self.assertEqual(self.cache.get_body("2-today"), b"build 2")
+            self.assertEqual(self.cache.get_body("2-today"), b"build 2")
+
+        self.assertEqual(results, [b"build 1"] * 8)
+
+
+class UpdatePayloadTestCase(TestCase):
+    def setUp(self):
+        self.user = DjoUser.objects.create_user(
+            username="idp-1", first_name="Test", last_name="User"
+        )
+        UserInfo.objects.create(user=self.user, days=1, account_type="lid")
+        today = datetime.date.today()
+        self.slot = Slot.objects.create(
+            name=today.strftime("%a").lower(), pod="m", description="Test Slot"
+        )
+
+    def changes(self, event):
+        with patch.object(updates.bus, "notify") as notify:
+            with self.captureOnCommitCallbacks(execute=True):
+                register(self.slot, self.user)
+        return [call.kwargs for call in notify.call_args_list if call.args[0] == event]
+
+    def test_version_is_bumped(self):
+        version = StateVersion.current()
+        register(self.slot, self.user)
+        self.assertEqual(StateVersion.current(), version + 1)
+        mark_seen(Presence.objects.get().pk, "true")
+        self.assertEqual(StateVersion.current(), version + 2)
+
+    def test_report_delta(self):
+        (changes,) = self.changes("update_report_page")
+        messages = updates.build_messages("update_report_page", changes)
+        self.assertEqual(len(messages), 2)
+        room, payload = messages[0]
+        slot_room, slot_payload = messages[1]
+        self.assertEqual(room, "report")
+        self.assertEqual(slot_room, f"report:{self.slot.name}-m")
+        self.assertEqual(slot_payload, payload)
+
+        self.assertEqual(payload["version"], StateVersion.current())
+        (slot,) = payload["slots"]
+        self.assertEqual((slot["name"], slot["pod"]), (self.slot.name, "m"))
+        self.assertEqual((slot["taken"], slot["available"]), (1, 15))
+        (added,) = payload["added"]
+        self.assertEqual(added["name"], "Test User")
+        self.assertEqual(added["date"], self.slot.date.isoformat())
+        self.assertFalse(added["tutor"])
+
+    def test_other_weeks_are_skipped(self):
+        (changes,) = self.changes("update_main_page")
+        changes["slots"] = [(self.slot.date + datetime.timedelta(days=7), "m")]
+        self.assertEqual(updates.build_messages("update_main_page", changes), [])
+
+
+class SocketConnectTestCase(TestCase):
+    def setUp(self):
+        self.user = DjoUser.objects.create_user(username="idp-1")
+        self.tutor = DjoUser.objects.create_superuser(username="idp-2")
+
+    def environ(self, user):
+        client = Client()
+        client.force_login(user)
+        return {"HTTP_COOKIE": f"sessionid={client.cookies['sessionid'].value}"}
+
+    def connect(self, user, auth):
+        with patch.object(updates, "get_socket_user", return_value=user), patch.object(
+            updates.sio, "enter_room"
+        ) as enter_room:
+            connected = async_to_sync(updates.connect)("sid", {}, auth)
+        return connected, [call.args[1] for call in enter_room.call_args_list]
+
+    def test_session_user(self):
+        self.assertEqual(updates.get_socket_user(self.environ(self.user)), self.user)
+        self.assertIsNone(updates.get_socket_user({}))
+        self.assertIsNone(updates.get_socket_user({"HTTP_COOKIE": "sessionid=nope"}))
+
+    def test_rooms(self):
+        self.assertEqual(self.connect(None, {}), (False, []))
+        self.assertEqual(self.connect(self.user, None), (True, ["main"]))
+        self.assertEqual(self.connect(self.user, {"page": "report"}), (False, []))
+        self.assertEqual(
+            self.connect(self.tutor, {"page": "report"}), (True, ["report"])
+        )
+        self.assertEqual(
+            self.connect(self.user, {"page": "main", "slots": ["fri-e", "sat-m"]}),
+            (True, ["main:fri-e", "main:sat-m"]),
+        )
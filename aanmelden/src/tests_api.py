@@ -1,17 +1,39 @@
 import datetime
 import json
+import time
 from unittest.mock import patch
 
+import jwt
+from cryptography.hazmat.primitives.asymmetric import rsa
+
 from django.contrib.auth import get_user_model
+from django.contrib.sessions.models import Session
+from django.core.cache import cache
+from django.db import connection
 from django.test import TestCase, Client
+from django.test.utils import CaptureQueriesContext
 
-from aanmelden.src.models import Slot, UserInfo, Presence, MacAddress
+from aanmelden.src import api, metrics
+from aanmelden.src.macindex import mac_index
+from aanmelden.src.mixins import sync_user
+from aanmelden.src.models import (
+    Attendance,
+    Slot,
+    UserInfo,
+    Presence,
+    MacAddress,
+    Occupancy,
+    StateVersion,
+)
 
 DjoUser = get_user_model()
 
 
 class ApiTestCase(TestCase):
     def setUp(self):
+        # The tests reuse the same token with different claims
+        cache.clear()
+        mac_index.clear()
         self.client = Client()
         # Create a normal user
         self.user = DjoUser.objects.create_user(
@@ -51,6 +73,27 @@ class ApiTestCase(TestCase):
             self.assertNotIn("tutors", data[0])
             self.assertNotIn("is_registered", data[0])
 
+    def test_free_v2_etag(self):
+        response = self.client.get("/api/v2/free")
+        etag = response["ETag"]
+
+        # The body is cached, only the version is read
+        with self.assertNumQueries(1):
+            cached = self.client.get("/api/v2/free")
+        self.assertEqual(cached.content, response.content)
+        self.assertEqual(cached["Content-Type"], "application/json")
+
+        # Only the version is read
+        with self.assertNumQueries(1):
+            response = self.client.get("/api/v2/free", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        Presence.objects.create(user=self.user, date=self.today, pod=self.slot.pod)
+        response = self.client.get("/api/v2/free", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertEqual(response.json()[0]["taken"], 1)
+
     def test_mac_event(self):
         MacAddress.objects.create(user=self.user, mac="aa:bb:cc:dd:ee:ff")
         Presence.objects.create(user=self.user, date=self.today, pod=self.slot.pod)
@@ -76,6 +119,205 @@ class ApiTestCase(TestCase):
         self.assertTrue(presence.seen)
         self.assertEqual(presence.seen_by, "mac")
 
+    @patch("aanmelden.src.mixins.introspection_client.fetch")
+    def test_are_present_with_client_credentials(self, mock_fetch):
+        Presence.objects.create(
+            user=self.user, date=self.today, pod=self.slot.pod, seen=True
+        )
+        path = f"/api/v2/are_present/{self.slot.name}/{self.slot.pod}"
+        headers = {"Authorization": "Bearer client-token"}
+
+        mock_fetch.return_value = {"active": True, "client_id": "other"}
+        with patch.object(api.ArePresentV2, "whitelisted_client_ids", ["corvee"]):
+            response = self.client.post(path, headers=headers)
+        self.assertEqual(response.status_code, 403)
+
+        cache.clear()
+        mock_fetch.return_value = {"active": True, "client_id": "corvee"}
+        with patch.object(api.ArePresentV2, "whitelisted_client_ids", ["corvee"]):
+            response = self.client.post(path, headers=headers)
+            self.assertEqual(response.json(), {"members": ["idp-1"]})
+            # Cached
+            self.client.post(path, headers=headers)
+        self.assertEqual(mock_fetch.call_count, 2)
+
+    @patch("aanmelden.src.mixins.introspection_client.fetch")
+    def test_presence_matrix(self, mock_fetch):
+        mock_fetch.return_value = {"active": True, "client_id": "corvee"}
+        Presence.objects.create(
+            user=self.user, date=self.today, pod=self.slot.pod, seen=True
+        )
+        Presence.objects.create(user=self.superuser, date=self.today, pod="a")
+        other = Slot.objects.create(name=self.slot.name, pod="a", description="")
+
+        def post(body):
+            with patch.object(api.PresenceMatrix, "whitelisted_client_ids", ["corvee"]):
+                return self.client.post(
+                    "/api/v2/presence_matrix",
+                    data=json.dumps(body),
+                    content_type="application/json",
+                    headers={"Authorization": "Bearer client-token"},
+                )
+
+        slots = [
+            {"day": self.slot.name, "pod": self.slot.pod},
+            {"day": other.name, "pod": other.pod},
+            {"day": self.slot.name, "pod": "x"},
+        ]
+        users = ["idp-1", "idp-2", "idp-3"]
+        # One query for the slots, one for the presences
+        with self.assertNumQueries(2):
+            response = post({"users": users, "slots": slots})
+        self.assertEqual(
+            response.json(),
+            {
+                "slots": {
+                    f"{self.slot.name}-{self.slot.pod}": {
+                        "date": self.today.isoformat(),
+                        "present": {"idp-1": True, "idp-2": False, "idp-3": False},
+                    },
+                    f"{other.name}-a": {
+                        "date": self.today.isoformat(),
+                        "present": {"idp-1": False, "idp-2": False, "idp-3": False},
+                    },
+                    f"{self.slot.name}-x": None,
+                }
+            },
+        )
+
+        response = post({"slots": slots[:1]})
+        self.assertEqual(
+            response.json()["slots"][f"{self.slot.name}-{self.slot.pod}"]["present"],
+            {"idp-1": True},
+        )
+        self.assertEqual(post({"users": "idp-1", "slots": slots}).status_code, 400)
+        self.assertEqual(post({"users": users}).status_code, 400)
+
+    @patch("aanmelden.src.mixins.introspection_client.fetch")
+    @patch("aanmelden.src.mixins.get_openid_configuration")
+    @patch("aanmelden.src.mixins.get_jwks_client")
+    def test_are_present_with_signed_client_token(
+        self, mock_jwks, mock_openid, mock_fetch
+    ):
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        mock_jwks.return_value.get_signing_key_from_jwt.return_value.key = (
+            key.public_key()
+        )
+        mock_openid.return_value = {"id_token_signing_alg_values_supported": ["RS256"]}
+        path = f"/api/v2/are_present/{self.slot.name}/{self.slot.pod}"
+
+        def post(claims):
+            token = jwt.encode(claims, key, "RS256")
+            return self.client.post(path, headers={"Authorization": f"Bearer {token}"})
+
+        exp = int(time.time()) + 60
+        with patch.object(api.ArePresentV2, "whitelisted_client_ids", ["corvee"]):
+            self.assertEqual(post({"client_id": "corvee", "exp": exp}).status_code, 200)
+            self.assertEqual(post({"client_id": "other", "exp": exp}).status_code, 403)
+            self.assertEqual(post({"client_id": "corvee"}).status_code, 403)
+            self.assertEqual(
+                post({"client_id": "corvee", "exp": exp - 120}).status_code, 403
+            )
+        # Verified locally
+        mock_fetch.assert_not_called()
+
+    def test_mac_event_batch(self):
+        MacAddress.objects.create(user=self.user, mac="aa:bb:cc:dd:ee:ff")
+        MacAddress.objects.create(user=self.superuser, mac="aa:bb:cc:dd:ee:00")
+        Presence.objects.create(user=self.user, date=self.today, pod=self.slot.pod)
+
+        body = "\n".join(
+            [
+                "join AA:BB:CC:DD:EE:FF extra",
+                "join aa:bb:cc:dd:ee:00 extra",
+                "join 11:22:33:44:55:66 extra",
+                "leave aa:bb:cc:dd:ee:ff extra",
+                "join aa:bb extra",
+                "garbage",
+                "",
+            ]
+        )
+        response = self.client.post(
+            "/api/v1/mac_event", data=body, content_type="text/plain"
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.json()["results"],
+            [
+                "seen",
+                "not_registered",
+                "unknown_mac",
+                "ignored",
+                "malformed_mac",
+                "malformed",
+            ],
+        )
+        presence = Presence.objects.get(user=self.user, date=self.today)
+        self.assertTrue(presence.seen)
+        self.assertEqual(presence.seen_by, "mac")
+        self.assertEqual(Attendance.objects.get(user=self.user).seen, 1)
+
+        # The number of queries does not depend on the number of events
+        presence.seen = False
+        presence.save()
+        with CaptureQueriesContext(connection) as one:
+            self.client.post(
+                "/api/v1/mac_event",
+                data="join aa:bb:cc:dd:ee:ff x",
+                content_type="text/plain",
+            )
+        presence.seen = False
+        presence.save()
+        with CaptureQueriesContext(connection) as many:
+            self.client.post("/api/v1/mac_event", data=body, content_type="text/plain")
+        self.assertEqual(len(one), len(many))
+
+    def test_mac_event_repeated_joins(self):
+        mac = MacAddress.objects.create(user=self.user, mac="aa:bb:cc:dd:ee:ff")
+        presence = Presence.objects.create(
+            user=self.user, date=self.today, pod=self.slot.pod
+        )
+
+        def join(line="join aa:bb:cc:dd:ee:ff x"):
+            return self.client.post(
+                "/api/v1/mac_event", data=line, content_type="text/plain"
+            ).content
+
+        self.assertEqual(join(), b"OK")
+        counters = metrics.snapshot()["counters"]
+        with self.assertNumQueries(0):
+            self.assertEqual(join(), b"OK")
+            self.assertEqual(join("join 11:22:33:44:55:66 x"), b"Unknown MAC address")
+        self.assertEqual(
+            metrics.snapshot()["counters"]["mac_index_hits"],
+            counters["mac_index_hits"] + 2,
+        )
+
+        # Marked unseen by hand, a new join marks the user seen again
+        presence.seen = False
+        presence.save()
+        join()
+        presence.refresh_from_db()
+        self.assertTrue(presence.seen)
+
+        # Unmarked by another process, a join after the next reload marks the
+        # user seen again
+        Presence.objects.filter(pk=presence.pk).update(seen=False)
+        self.assertEqual(join(), b"OK")
+        presence.refresh_from_db()
+        self.assertFalse(presence.seen)
+        with patch.object(mac_index, "loaded_at", 0):
+            self.assertEqual(join(), b"OK")
+        presence.refresh_from_db()
+        self.assertTrue(presence.seen)
+
+        # The index follows changes to the MAC addresses
+        mac.mac = "aa:bb:cc:dd:ee:00"
+        mac.save()
+        self.assertEqual(join(), b"Unknown MAC address")
+        mac.delete()
+        self.assertEqual(join("join aa:bb:cc:dd:ee:00 x"), b"Unknown MAC address")
+
     def test_present_since_date(self):
         Presence.objects.create(
             user=self.user, date=self.today, pod=self.slot.pod, seen=True
@@ -123,6 +365,14 @@ class ApiTestCase(TestCase):
         self.assertIn("slots", data)
         self.assertIn("members", data)
 
+        response = self.client.get("/api/v1/slots", HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 304)
+        # A stripcard change is part of the members list
+        UserInfo.objects.filter(user=self.user).update(stripcard_count=10)
+        UserInfo.objects.get(user=self.user).save()
+        response = self.client.get("/api/v1/slots", HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 200)
+
     @patch("aanmelden.src.mixins.get_access_token")
     @patch("aanmelden.src.mixins.get_openid_configuration")
     @patch("aanmelden.src.mixins.get_jwks_client")
@@ -226,6 +476,168 @@ class ApiTestCase(TestCase):
             Presence.objects.filter(user=self.superuser, date=tomorrow).exists()
         )
 
+    @patch("aanmelden.src.mixins.get_access_token")
+    @patch("aanmelden.src.mixins.get_openid_configuration")
+    @patch("aanmelden.src.mixins.get_jwks_client")
+    @patch("jwt.decode")
+    def test_future_update_bulk(
+        self, mock_jwt_decode, _mock_jwks, mock_openid, mock_get_token
+    ):
+        mock_get_token.return_value = "fake-token"
+        mock_openid.return_value = {"id_token_signing_alg_values_supported": ["RS256"]}
+        mock_jwt_decode.return_value = {
+            "aanmelden": True,
+            "sub": "2",
+            "email": "admin@example.com",
+            "given_name": "Admin",
+            "family_name": "User",
+            "account_type": "begeleider",
+            "days": 7,
+            "stripcard": None,
+        }
+        weeks = [self.today + datetime.timedelta(weeks=i) for i in range(1, 9)]
+        Presence.objects.create(user=self.superuser, date=weeks[0], pod="m")
+
+        def patch_future(data):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.patch(
+                    "/api/v1/future",
+                    data=json.dumps(data),
+                    content_type="application/json",
+                )
+            self.assertEqual(response.status_code, 200)
+            return response.json()["results"], len(queries)
+
+        last_week = self.today - datetime.timedelta(weeks=1)
+        tomorrow = (self.today + datetime.timedelta(days=1)).isoformat()
+        # Dates are answered in ISO format, also when not given as such
+        unpadded = f"{last_week.year}-{last_week.month}-{last_week.day}"
+        last_week = last_week.isoformat()
+        results, _ = patch_future(
+            {"add": [d.isoformat() for d in weeks[:2]] + [unpadded, tomorrow, "x"]}
+        )
+        self.assertEqual(
+            results,
+            {
+                weeks[0].isoformat(): "already_registered",
+                weeks[1].isoformat(): "added",
+                last_week: "past",
+                tomorrow: "no_slot",
+                "x": "invalid_date",
+            },
+        )
+        self.assertEqual(Occupancy.get(weeks[1], "m").tutors, 1)
+
+        # The number of queries does not depend on the number of dates
+        _, few = patch_future({"add": [weeks[2].isoformat()]})
+        _, many = patch_future({"add": [d.isoformat() for d in weeks[3:]]})
+        self.assertEqual(few, many)
+        self.assertEqual(
+            Presence.objects.filter(user=self.superuser, date__gt=self.today).count(),
+            8,
+        )
+
+        results, _ = patch_future(
+            {"remove": [d.isoformat() for d in weeks[1:]] + [tomorrow]}
+        )
+        self.assertEqual(set(results.values()), {"removed", "no_slot"})
+        self.assertEqual(
+            Presence.objects.filter(user=self.superuser, date__gt=self.today).count(),
+            1,
+        )
+        self.assertEqual(Occupancy.get(weeks[1], "m").tutors, 0)
+        self.assertEqual(Occupancy.get(weeks[0], "m").tutors, 1)
+
+        # A date that is asked for twice is counted once
+        Presence.objects.filter(user=self.superuser, date=weeks[3]).delete()
+        unpadded = f"{weeks[3].year}-{weeks[3].month}-{weeks[3].day}"
+        results, _ = patch_future({"add": [weeks[3].isoformat(), unpadded]})
+        self.assertEqual(results, {weeks[3].isoformat(): "added"})
+        self.assertEqual(Occupancy.get(weeks[3], "m").tutors, 1)
+
+        # Removing seen presences uses the same bookkeeping as a single delete
+        Presence.objects.filter(user=self.superuser, date=weeks[0]).update(seen=True)
+        Attendance.adjust(self.superuser.pk, weeks[0], 1)
+        patch_future({"remove": [weeks[0].isoformat()]})
+        self.assertEqual(Occupancy.get(weeks[0], "m").tutors, 0)
+        self.assertEqual(
+            Attendance.objects.get(
+                user=self.superuser, month=weeks[0].replace(day=1)
+            ).seen,
+            0,
+        )
+
+    @patch("aanmelden.src.mixins.get_access_token")
+    @patch("aanmelden.src.mixins.get_openid_configuration")
+    @patch("aanmelden.src.mixins.get_jwks_client")
+    @patch("jwt.decode")
+    def test_recurring_api(
+        self, mock_jwt_decode, _mock_jwks, mock_openid, mock_get_token
+    ):
+        mock_get_token.return_value = "fake-token"
+        mock_openid.return_value = {"id_token_signing_alg_values_supported": ["RS256"]}
+        mock_jwt_decode.return_value = {
+            "aanmelden": True,
+            "sub": "2",
+            "email": "admin@example.com",
+            "given_name": "Admin",
+            "family_name": "User",
+            "account_type": "begeleider",
+            "days": 7,
+            "stripcard": None,
+        }
+        until = (self.today + datetime.timedelta(weeks=8)).isoformat()
+
+        response = self.client.post(
+            "/api/v1/recurring",
+            data=json.dumps({"name": self.slot.name, "pod": "m", "until": until}),
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 201)
+        rule_id = response.json()["id"]
+        self.assertEqual(
+            Presence.objects.filter(user=self.superuser, date__gte=self.today).count(),
+            3,
+        )
+
+        for body in (
+            {"name": self.slot.name, "pod": "x", "until": until},
+            {"name": self.slot.name, "pod": "m", "until": 20300101},
+            {"name": self.slot.name, "pod": "m"},
+            [self.slot.name, "m", until],
+            # Already exists
+            {"name": self.slot.name, "pod": "m", "until": until},
+        ):
+            response = self.client.post(
+                "/api/v1/recurring",
+                data=json.dumps(body),
+                content_type="application/json",
+            )
+            self.assertEqual(response.status_code, 400)
+
+        response = self.client.get("/api/v1/recurring")
+        self.assertEqual([rule["id"] for rule in response.json()["rules"]], [rule_id])
+
+        # A date the rule did not register for yet can be dropped as well
+        later = self.today + datetime.timedelta(weeks=5)
+        response = self.client.patch(
+            "/api/v1/future",
+            data=json.dumps({"remove": [later.isoformat()]}),
+            content_type="application/json",
+        )
+        self.assertEqual(response.json()["results"], {later.isoformat(): "removed"})
+        self.assertEqual(Presence.get_tutor_count(later, "m"), 0)
+
+        response = self.client.delete(f"/api/v1/recurring/{rule_id}")
+        self.assertEqual(response.status_code, 200)
+        response = self.client.delete(f"/api/v1/recurring/{rule_id}")
+        self.assertEqual(response.status_code, 404)
+        # Dates that were already registered are kept
+        self.assertEqual(
+            Presence.objects.filter(user=self.superuser, date__gte=self.today).count(),
+            3,
+        )
+
     @patch("aanmelden.src.mixins.get_access_token")
     @patch("aanmelden.src.mixins.get_openid_configuration")
     @patch("aanmelden.src.mixins.get_jwks_client")
@@ -282,3 +694,73 @@ class ApiTestCase(TestCase):
         self.assertFalse(
             Presence.objects.filter(user=self.user, pod=self.slot.pod).exists()
         )
+
+    @patch("aanmelden.src.mixins.get_access_token")
+    @patch("aanmelden.src.mixins.get_openid_configuration")
+    @patch("aanmelden.src.mixins.get_jwks_client")
+    @patch("jwt.decode")
+    def test_claims_are_cached(
+        self, mock_jwt_decode, _mock_jwks, mock_openid, mock_get_token
+    ):
+        mock_get_token.return_value = "fake-token"
+        mock_openid.return_value = {"id_token_signing_alg_values_supported": ["RS256"]}
+        mock_jwt_decode.return_value = {
+            "aanmelden": True,
+            "sub": "1",
+            "email": "user@example.com",
+            "given_name": "Test",
+            "family_name": "User",
+            "account_type": "lid",
+            "days": 3,
+            "stripcard": None,
+        }
+
+        avoided = metrics.snapshot()["counters"].get("session_writes_avoided", 0)
+        for _ in range(3):
+            response = self.client.get("/api/v1/slots")
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(mock_jwt_decode.call_count, 1)
+        # Token requests are stateless
+        self.assertNotIn("sessionid", self.client.cookies)
+        self.assertFalse(Session.objects.exists())
+        self.assertEqual(
+            metrics.snapshot()["counters"]["session_writes_avoided"], avoided + 3
+        )
+
+    def test_sync_user_writes_changes_only(self):
+        claims = {
+            "sub": "1",
+            "email": "user@example.com",
+            "given_name": "Test",
+            "family_name": "User",
+            "account_type": "lid",
+            "days": 3,
+            "stripcard": None,
+        }
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(sync_user(claims), self.user)
+        self.assertEqual(len(queries), 1)
+
+        # Fields that are not in the slot lists leave the state version alone
+        version = StateVersion.current()
+        claims["email"] = "new@example.com"
+        sync_user(claims)
+        self.assertEqual(StateVersion.current(), version)
+        claims["email"] = "user@example.com"
+        sync_user(claims)
+
+        claims["days"] = 2
+        claims["stripcard"] = {"used": 1, "count": 10, "expires": "2030-01-31"}
+        with CaptureQueriesContext(connection) as queries:
+            sync_user(claims)
+        # Select, update of the userinfo and the state version bump
+        self.assertEqual(len(queries), 3)
+        self.assertNotIn("email", queries[1]["sql"])
+        self.user_info.refresh_from_db()
+        self.assertEqual(self.user_info.days, 2)
+        self.assertEqual(self.user_info.stripcard_expires, datetime.date(2030, 1, 31))
+
+        claims["sub"] = "3"
+        user = sync_user(claims)
+        self.assertEqual(user.username, "idp-3")
+        self.assertEqual(user.userinfo.stripcard_count, 10)
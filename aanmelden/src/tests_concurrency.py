@@ -0,0 +1,96 @@
+import datetime
+import threading
+
+from django.contrib.auth import get_user_model
+from django.db import connection, transaction
+from django.test import TransactionTestCase
+
+from aanmelden.src.models import Slot, UserInfo, Presence, SpecialDate, Occupancy
+from aanmelden.src.api import register_future_many
+from aanmelden.src.utils import register, register_future, RegisterException
+
+DjoUser = get_user_model()
+
+
+def run_parallel(targets):
+    barrier = threading.Barrier(len(targets))
+    errors = []
+
+    def run(target):
+        try:
+            barrier.wait()
+            target()
+        except RegisterException:
+            pass
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            errors.append(e)
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=run, args=(target,)) for target in targets]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors
+
+
+class ConcurrentRegisterTestCase(TransactionTestCase):
+    def setUp(self):
+        today = datetime.date.today()
+        self.slot = Slot.objects.create(
+            name=today.strftime("%a").lower(), pod="m", description="Test Slot"
+        )
+        SpecialDate.objects.create(date=today, free_slots=5, closed=False)
+
+    def create_user(self, username, days=1):
+        user = DjoUser.objects.create_user(username=username)
+        UserInfo.objects.create(user=user, days=days, account_type="lid")
+        return user
+
+    def test_capacity_is_never_exceeded(self):
+        slot = self.slot
+        users = [self.create_user(f"idp-{i}") for i in range(50)]
+
+        errors = run_parallel(
+            [lambda user=user: register(slot, user) for user in users]
+        )
+
+        self.assertEqual(errors, [])
+        self.assertEqual(Presence.objects.filter(date=slot.date).count(), 5)
+        occupancy = Occupancy.objects.get(date=slot.date, pod=slot.pod)
+        self.assertEqual(occupancy.members, 5)
+
+    def test_weekly_limit_is_never_exceeded(self):
+        user = self.create_user("idp-1", days=1)
+        slots = [
+            Slot.objects.create(name=self.slot.name, pod=pod, description=pod)
+            for pod in ("a", "e")
+        ] + [self.slot]
+
+        errors = run_parallel(
+            [
+                lambda slot=slot: register(slot, DjoUser.objects.get(pk=user.pk))
+                for slot in slots
+                for _ in range(10)
+            ]
+        )
+
+        self.assertEqual(errors, [])
+        self.assertEqual(Presence.objects.filter(user=user).count(), 1)
+
+    def test_future_registrations_are_counted_once(self):
+        tutor = DjoUser.objects.create_superuser(username="idp-2")
+        day = self.slot.date + datetime.timedelta(weeks=1)
+
+        def register_many():
+            with transaction.atomic():
+                register_future_many(DjoUser.objects.get(pk=tutor.pk), {day: "m"}, {})
+
+        errors = run_parallel(
+            [register_many for _ in range(5)]
+            + [lambda: register_future(day, self.slot, tutor) for _ in range(5)]
+        )
+
+        self.assertEqual(errors, [])
+        self.assertEqual(Occupancy.get(day, "m").tutors, 1)
@@ -0,0 +1,121 @@
+import datetime
+from unittest.mock import patch
+
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.test import TestCase
+
+from aanmelden.src.models import (
+    Occupancy,
+    Presence,
+    RecurringPresence,
+    Slot,
+    UserInfo,
+)
+from aanmelden.src.utils import deregister_future, register
+
+DjoUser = get_user_model()
+
+
+class RecurringPresenceTestCase(TestCase):
+    def setUp(self):
+        self.tutor = DjoUser.objects.create_superuser(
+            username="idp-2", first_name="Tutor"
+        )
+        self.today = datetime.date.today()
+        self.slot = Slot.objects.create(
+            name=self.today.strftime("%a").lower(), pod="e", description="Test Slot"
+        )
+        self.rule = RecurringPresence.objects.create(
+            user=self.tutor,
+            name=self.slot.name,
+            pod="e",
+            until=self.today + datetime.timedelta(weeks=10),
+        )
+
+    def weeks(self, count):
+        return self.today + datetime.timedelta(weeks=count)
+
+    def test_expanded_one_window_ahead(self):
+        self.assertEqual(
+            list(
+                Presence.objects.filter(user=self.tutor)
+                .order_by("date")
+                .values_list("date", flat=True)
+            ),
+            [self.today, self.weeks(1), self.weeks(2)],
+        )
+        self.assertEqual(Occupancy.get(self.weeks(1), "e").tutors, 1)
+        self.rule.refresh_from_db()
+        self.assertEqual(self.rule.expanded_until, self.weeks(2))
+
+        # Expanding again adds nothing
+        RecurringPresence.objects.update(expanded_until=None)
+        call_command("expand_recurring")
+        self.assertEqual(Presence.objects.count(), 3)
+        self.assertEqual(Occupancy.get(self.weeks(1), "e").tutors, 1)
+
+    def test_deregistered_dates_stay_deregistered(self):
+        Presence.objects.get(user=self.tutor, date=self.weeks(1)).delete()
+        rule = RecurringPresence.objects.get()
+        rule.save()
+        self.assertFalse(Presence.objects.filter(date=self.weeks(1)).exists())
+
+        # Unless the rule itself changed
+        rule.until = self.weeks(20)
+        rule.save()
+        self.assertTrue(Presence.objects.filter(date=self.weeks(1)).exists())
+
+    def test_later_dates_are_counted_from_the_rule(self):
+        self.assertFalse(Presence.objects.filter(date=self.weeks(5)).exists())
+        self.assertEqual(Presence.get_tutor_count(self.weeks(5), "e"), 1)
+        self.assertEqual(Presence.get_tutor_count(self.weeks(5)), 1)
+        self.assertEqual(Presence.get_tutor_count(self.weeks(11), "e"), 0)
+        # Expanded dates are not counted twice
+        self.assertEqual(Presence.get_tutor_count(self.weeks(1), "e"), 1)
+        self.assertEqual(
+            Presence.slots_available(self.weeks(5), "e"),
+            Presence.slots_available(self.weeks(1), "e"),
+        )
+
+        # Not counted again for the expanded dates, also when the rule is
+        # behind
+        RecurringPresence.objects.update(expanded_until=None)
+        snapshot = Slot.get_enabled_slots()[0]
+        self.assertEqual(snapshot["tutor_count"], 1)
+        self.assertEqual(snapshot["tutors"], ["Tutor"])
+
+    def test_registered_dates_are_not_pending(self):
+        Presence.objects.create(user=self.tutor, date=self.weeks(5), pod="e")
+        self.assertEqual(Presence.get_tutor_count(self.weeks(5), "e"), 1)
+        self.assertEqual(RecurringPresence.pending_tutors([self.weeks(5)]), {})
+
+    def test_deregistered_dates_are_skipped(self):
+        deregister_future(self.weeks(5), self.slot, self.tutor)
+        self.assertEqual(Presence.get_tutor_count(self.weeks(5), "e"), 0)
+        self.assertEqual(Presence.get_tutor_count(self.weeks(4), "e"), 1)
+
+        with patch.object(RecurringPresence, "WINDOW", datetime.timedelta(weeks=6)):
+            call_command("expand_recurring")
+        self.assertEqual(
+            list(
+                Presence.objects.filter(date__gt=self.weeks(2))
+                .order_by("date")
+                .values_list("date", flat=True)
+            ),
+            [self.weeks(3), self.weeks(4), self.weeks(6)],
+        )
+
+    def test_pending_tutors_count_for_admission(self):
+        # The rule is not expanded up to today yet
+        Presence.objects.get(user=self.tutor, date=self.today).delete()
+        RecurringPresence.objects.update(expanded_until=None)
+        Occupancy.objects.filter(date=self.today, pod="e").update(members=16)
+        self.assertEqual(Presence.slots_available(self.today, "e"), 4)
+
+        user = DjoUser.objects.create_user(username="idp-1")
+        UserInfo.objects.create(user=user, days=1)
+        register(self.slot, user)
+        self.assertTrue(Presence.objects.filter(user=user).exists())
+        self.assertEqual(Presence.slots_available(self.today, "e"), 3)
+        self.assertEqual(Slot.get_enabled_slots()[0]["available"], 3)
@@ -0,0 +1,217 @@
+from importlib import import_module
+
+import jwt
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user
+from django.db import close_old_connections, transaction
+from django.http import HttpRequest
+from django.http.cookie import parse_cookie
+
+from aanmelden.sockets import sio, bus
+from aanmelden.src.mixins import decode_access_token
+from aanmelden.src.models import DjoUser, Slot, StateVersion
+
+
+def notify(event, **changes):
+    # Only publish the changes once they are visible to other connections
+    transaction.on_commit(lambda: bus.notify(event, **changes))
+
+
+def presence_item(presence, **fields):
+    return {"id": presence.pk, "date": presence.date, "pod": presence.pod, **fields}
+
+
+def presence_added(presence):
+    presences_added([presence])
+
+
+def presences_added(presences):
+    items = []
+    for presence in presences:
+        user = presence.user
+        stripcard = None
+        if hasattr(user, "userinfo") and "strippenkaart" in user.userinfo.account_type:
+            stripcard = {
+                "used": user.userinfo.stripcard_used,
+                "count": user.userinfo.stripcard_count,
+            }
+        items.append(
+            presence_item(
+                presence,
+                name=f"{user.first_name} {user.last_name}",
+                tutor=presence.is_tutor,
+                seen=presence.seen,
+                seen_by=presence.seen_by,
+                stripcard=stripcard,
+            )
+        )
+
+    slots = [(presence.date, presence.pod) for presence in presences]
+    notify("update_main_page", slots=slots)
+    notify("update_report_page", slots=slots, added=items)
+
+
+def presence_changed(presence):
+    notify(
+        "update_report_page",
+        seen=[presence_item(presence, seen=presence.seen, seen_by=presence.seen_by)],
+    )
+
+
+def presence_removed(presence):
+    presences_removed([presence])
+
+
+def presences_removed(presences):
+    slots = [(presence.date, presence.pod) for presence in presences]
+    notify("update_main_page", slots=slots)
+    notify(
+        "update_report_page",
+        slots=slots,
+        removed=[presence_item(presence) for presence in presences],
+    )
+
+
+def slots_changed():
+    # The slots themselves changed, let the clients fetch the whole page
+    notify("update_main_page", reload=[True])
+    notify("update_report_page", reload=[True])
+
+
+PAGE_ROOMS = {"update_main_page": "main", "update_report_page": "report"}
+
+
+def slot_room(page, slot):
+    return f"{page}:{slot['name']}-{slot['pod']}"
+
+
+def build_messages(event, changes):
+    """
+    Turn the queued changes into the deltas sent to the clients, as a list of
+    (room, payload). A delta holds the current counts of the changed slots and,
+    for the report page, the added, changed and removed presences. The page
+    room gets all changes, the room of a slot only the changes to that slot.
+    Only slots of the current week are included.
+    """
+    page = PAGE_ROOMS[event]
+    version = StateVersion.current()
+    slots = {(slot["date"], slot["pod"]): slot for slot in Slot.get_enabled_slots()}
+
+    if changes.get("reload"):
+        rooms = [page] + [slot_room(page, slot) for slot in slots.values()]
+        return [(rooms, {"version": version, "reload": True})]
+
+    deltas = {}
+    fields = ["slots"]
+    if event == "update_report_page":
+        fields += ["added", "seen", "removed"]
+
+    for key in dict.fromkeys(changes.get("slots", [])):
+        if key in slots:
+            delta = deltas.setdefault(key, {field: [] for field in fields})
+            delta["slots"].append(
+                {
+                    "name": slots[key]["name"],
+                    "pod": slots[key]["pod"],
+                    "date": slots[key]["date"].isoformat(),
+                    "taken": slots[key]["taken"],
+                    "available": slots[key]["available"],
+                    "tutor_count": slots[key]["tutor_count"],
+                    "tutors": slots[key]["tutors"],
+                    "version": version,
+                }
+            )
+    for field in fields[1:]:
+        for item in changes.get(field, []):
+            key = (item["date"], item["pod"])
+            if key in slots:
+                delta = deltas.setdefault(key, {field: [] for field in fields})
+                delta[field].append({**item, "date": item["date"].isoformat()})
+
+    if not deltas:
+        return []
+
+    payload = {"version": version, **{field: [] for field in fields}}
+    for delta in deltas.values():
+        for field, items in delta.items():
+            payload[field].extend(items)
+
+    messages = [(page, payload)]
+    for key, delta in deltas.items():
+        messages.append((slot_room(page, slots[key]), {"version": version, **delta}))
+    return messages
+
+
+def get_socket_user(environ, token=None):
+    """The user of a socket connection, from its access token or session cookie"""
+    if token:
+        try:
+            claims = decode_access_token(token)
+        except jwt.PyJWTError:
+            return None
+        if not claims["aanmelden"]:
+            return None
+        return DjoUser.objects.filter(username=f"idp-{claims['sub']}").first()
+
+    request = HttpRequest()
+    session_key = parse_cookie(environ.get("HTTP_COOKIE", "")).get(
+        settings.SESSION_COOKIE_NAME
+    )
+    request.session = import_module(settings.SESSION_ENGINE).SessionStore(session_key)
+    user = get_user(request)
+    if not user.is_authenticated:
+        return None
+    return user
+
+
+def in_worker(func):
+    # Runs in a worker thread of the event loop, outside of any request
+    def wrapper(*args, **kwargs):
+        close_old_connections()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+
+    return wrapper
+
+
+bus.build = in_worker(build_messages)
+
+
+@sio.event
+async def connect(sid, environ, auth=None):
+    """
+    Only authenticated clients may connect. They are put in the room of the
+    page they show (main or report), or only in the rooms of the slots they
+    ask for, e.g. {"page": "main", "slots": ["fri-e"]}.
+    """
+    auth = auth if isinstance(auth, dict) else {}
+    user = await sync_to_async(in_worker(get_socket_user), thread_sensitive=False)(
+        environ, auth.get("token")
+    )
+    if user is None:
+        return False
+
+    page = auth.get("page", "main")
+    if page not in PAGE_ROOMS.values():
+        return False
+    if page == "report" and not user.is_superuser:
+        return False
+
+    slots = auth.get("slots")
+    if slots and isinstance(slots, list):
+        rooms = [f"{page}:{slot}" for slot in slots if isinstance(slot, str)]
+    else:
+        rooms = [page]
+    for room in rooms:
+        await sio.enter_room(sid, room)
+    return True
+
+
+@sio.on("version")
+async def get_version(sid, data=None):  # pylint: disable=unused-argument
+    # Clients compare this to the version their page was rendered with, to
+    # detect changes they missed while not connected
+    return await sync_to_async(StateVersion.current)()
@@ -1,14 +1,17 @@
-import asyncio
 import datetime
 from datetime import timedelta
-from functools import lru_cache
-import requests
 from django.conf import settings
-from django.db import IntegrityError
-from jwt import PyJWKClient
+from django.db import IntegrityError, transaction
 
-from aanmelden.sockets import sio
-from aanmelden.src.models import Presence, DjoUser
+from aanmelden.src.models import (
+    Presence,
+    DjoUser,
+    Occupancy,
+    RecurringException,
+    RecurringPresence,
+    SpecialDate,
+)
+from aanmelden.src.provider import ProviderMetadata
 
 
 class RegisterException(Exception):
@@ -31,40 +34,53 @@ class JochDetectedException(RegisterException):
     pass
 
 
-def register(slot, user, skip_checks=False):
-    if not skip_checks:
-        if Presence.slots_available(slot.date, slot.pod) <= 0:
-            raise NotEnoughSlotsException()
+def check_admission(slot, user):
+    """
+    Check if the user may register for the slot. Must be called in the same
+    transaction as the Presence write: the user and the slot counters are
+    locked, so concurrent registrations are admitted one at a time.
+    """
+    # Lock order is user -> slot, to prevent deadlocks between registrations
+    DjoUser.lock(user.pk)
+    occupancy = Occupancy.lock(slot.date, slot.pod)
+
+    special_date = SpecialDate.get(slot.date, slot.pod)
+    if Presence.available_in(occupancy, special_date) <= 0:
+        raise NotEnoughSlotsException()
+
+    date = slot.date
+    start = date - timedelta(days=date.weekday())
+    end = start + timedelta(days=6)
 
-        date = slot.date
-        start = date - timedelta(days=date.weekday())
-        end = start + timedelta(days=6)
+    reg_count = Presence.objects.filter(
+        date__gte=start, date__lte=end, user=user
+    ).count()
 
-        reg_count = Presence.objects.filter(
-            date__gte=start, date__lte=end, user=user
-        ).count()
+    if reg_count >= user.userinfo.days:
+        raise TooManyDaysException()
 
-        if reg_count >= user.userinfo.days:
-            raise TooManyDaysException()
+    if DjoUser.has_strippenkaart(user.userinfo.account_type):
+        if user.userinfo.stripcard_used >= user.userinfo.stripcard_count:
+            raise StripcardLimitReachedException()
 
-        if DjoUser.has_strippenkaart(user.userinfo.account_type):
-            if user.userinfo.stripcard_used >= user.userinfo.stripcard_count:
-                raise StripcardLimitReachedException()
 
+def register(slot, user, skip_checks=False):
     presence = Presence()
     presence.date = slot.date
     presence.pod = slot.pod
     presence.user = user
 
     try:
-        presence.save()
+        with transaction.atomic():
+            if skip_checks:
+                DjoUser.lock(user.pk)
+            else:
+                check_admission(slot, user)
+            presence.save()
     except IntegrityError:
         # Already registered -> ignore
         pass
 
-    asyncio.run(sio.emit("update_report_page"))
-    asyncio.run(sio.emit("update_main_page"))
-
     return presence
 
 
@@ -85,20 +101,13 @@ def register_future(date, slot, user):
         raise JochDetectedException
 
     try:
-        presence.save()
+        with transaction.atomic():
+            DjoUser.lock(user.pk)
+            presence.save()
     except IntegrityError:
         # Already registered -> ignore
         pass
 
-    # get start and end of registered week
-    date_start = slot.date - timedelta(days=slot.date.weekday())
-    date_end = date_start + timedelta(days=6)
-
-    # only update if register date is in current week
-    if date_start <= date <= date_end:
-        asyncio.run(sio.emit("update_report_page"))
-        asyncio.run(sio.emit("update_main_page"))
-
     return presence
 
 
@@ -107,13 +116,12 @@ def mark_seen(pk, seen):
         presence = Presence.objects.get(pk=pk)
         presence.seen = seen == "true"
         presence.seen_by = "manual"
-        presence.save()
+        with transaction.atomic():
+            presence.save()
     except Presence.DoesNotExist:
         # Presence not found, who cares
         pass
 
-    asyncio.run(sio.emit("update_report_page"))
-
 
 class DeRegisterException(Exception):
     pass
@@ -123,46 +131,55 @@ class AlreadySeenException(DeRegisterException):
     pass
 
 
+def skip_recurring(user, date, pod):
+    """Keep the recurring rules of the user from registering the date again"""
+    if not user.is_superuser:
+        # Only tutors have recurring rules
+        return
+    for exception in RecurringPresence.skipped_by(user, [(date, pod)]):
+        RecurringException.objects.get_or_create(
+            rule=exception.rule, date=exception.date
+        )
+
+
 def deregister(slot, user):
     try:
         presence = Presence.objects.get(date=slot.date, user=user, pod=slot.pod)
     except Presence.DoesNotExist:
-        return
+        presence = None
 
-    if presence.seen:
+    if presence and presence.seen:
         raise AlreadySeenException()
 
-    presence.delete()
-
-    asyncio.run(sio.emit("update_report_page"))
-    asyncio.run(sio.emit("update_main_page"))
+    with transaction.atomic():
+        skip_recurring(user, slot.date, slot.pod)
+        if presence:
+            presence.delete()
 
 
 def deregister_future(date, slot, user):
-    try:
-        presence = Presence.objects.get(date=date, user=user, pod=slot.pod)
-    except Presence.DoesNotExist:
-        return
-
-    presence.delete()
+    with transaction.atomic():
+        # Also for dates the rules did not register for yet
+        skip_recurring(user, date, slot.pod)
+        try:
+            presence = Presence.objects.get(date=date, user=user, pod=slot.pod)
+        except Presence.DoesNotExist:
+            return
+        presence.delete()
 
-    # only update if deregister date is in current week
-    date_start = slot.date - timedelta(days=slot.date.weekday())
-    date_end = date_start + timedelta(days=6)
 
-    if date_start <= date <= date_end:
-        asyncio.run(sio.emit("update_report_page"))
-        asyncio.run(sio.emit("update_main_page"))
+provider_metadata = ProviderMetadata(
+    settings.OPENID_CONFIGURATION,
+    cache_file=getattr(settings, "OPENID_CACHE_FILE", None),
+)
 
 
-@lru_cache()
 def get_openid_configuration():
-    return requests.get(settings.OPENID_CONFIGURATION, timeout=10).json()
+    return provider_metadata.get_openid_configuration()
 
 
-@lru_cache()
 def get_jwks_client():
-    return PyJWKClient(uri=get_openid_configuration()["jwks_uri"])
+    return provider_metadata
 
 
 def get_access_token(request) -> tuple[str, None]:
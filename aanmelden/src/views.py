@@ -1,11 +1,16 @@
-import asyncio
-
 from django.conf import settings
 from django.contrib.auth import logout, login as auth_login
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.db import IntegrityError
+from django.db import IntegrityError, transaction
 from django.forms.models import model_to_dict
-from django.http import HttpResponseRedirect, HttpResponseForbidden, JsonResponse
+from django.core.handlers.asgi import ASGIRequest
+from django.http import (
+    HttpResponseBadRequest,
+    HttpResponseForbidden,
+    HttpResponseRedirect,
+    JsonResponse,
+    StreamingHttpResponse,
+)
 from django.urls import reverse, reverse_lazy
 from django.utils.dateparse import parse_date
 from django.utils.decorators import method_decorator
@@ -15,9 +20,13 @@ from django.views.generic import View, ListView, TemplateView
 from django.views.generic.edit import CreateView
 from requests_oauthlib import OAuth2Session
 
-from aanmelden.sockets import sio
-from aanmelden.src.mixins import BegeleiderRequiredMixin, SlotContextMixin
-from aanmelden.src.models import Presence, DjoUser, UserInfo, Slot
+from aanmelden.src.export import FORMATS, presence_rows, stream_async
+from aanmelden.src.mixins import (
+    BegeleiderRequiredMixin,
+    SlotContextMixin,
+    sync_user,
+)
+from aanmelden.src.models import Presence, Slot, StateVersion
 from aanmelden.src.utils import (
     register,
     register_future,
@@ -75,34 +84,24 @@ class LoginResponseView(View):
             return HttpResponseForbidden("IDP Login mislukt")
 
         user_profile = oauth.get(settings.IDP_API_URL).json()
-        username = f"idp-{user_profile['id']}"
-
-        try:
-            found_user = DjoUser.objects.get(username=username)
-        except DjoUser.DoesNotExist:
-            found_user = DjoUser()
-            found_user.username = username
-            found_user.set_unusable_password()
-
-        if not hasattr(found_user, "userinfo"):
-            found_user.userinfo = UserInfo()
-        found_user.email = user_profile["email"]
-        found_user.first_name = user_profile["firstName"]
-        found_user.last_name = user_profile["lastName"]
-        account_type = user_profile["accountType"]
-        found_user.is_superuser = DjoUser.is_begeleider(account_type)
-        found_user.userinfo.days = user_profile["days"]
-        found_user.userinfo.account_type = account_type
+        claims = {
+            "sub": user_profile["id"],
+            "email": user_profile["email"],
+            "given_name": user_profile["firstName"],
+            "family_name": user_profile["lastName"],
+            "account_type": user_profile["accountType"],
+            "days": user_profile["days"],
+            "stripcard": None,
+        }
         if "stripcard_used" in user_profile:
-            found_user.userinfo.stripcard_used = user_profile["stripcard_used"]
-            found_user.userinfo.stripcard_count = user_profile["stripcard_count"]
-            found_user.userinfo.stripcard_expires = user_profile["stripcard_expires"]
-        else:
-            # No active stripcard -> reset counters
-            found_user.userinfo.stripcard_used = 0
-            found_user.userinfo.stripcard_count = 0
-        found_user.save()
-        found_user.userinfo.save()
+            claims["stripcard"] = {
+                "used": user_profile["stripcard_used"],
+                "count": user_profile["stripcard_count"],
+                "expires": user_profile["stripcard_expires"],
+            }
+        # Only writes the fields that changed, so a login does not invalidate
+        # the cached slot lists
+        found_user = sync_user(claims)
 
         auth_login(request, found_user)
 
@@ -124,6 +123,8 @@ class Main(LoginRequiredMixin, TemplateView):
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data()
+        # Read the version first, so the page is never older than its version
+        context.update({"version": StateVersion.current()})
         context.update({"slots": Slot.get_enabled_slots(self.request.user)})
         return context
 
@@ -199,14 +200,30 @@ class Report(BegeleiderRequiredMixin, LoginRequiredMixin, ListView):
     model = Presence
 
     def get_context_data(self, *, object_list=None, **kwargs):
+        # Read the version before the (lazy) presences and slots are loaded
+        version = StateVersion.current()
         context = super().get_context_data()
-        context.update({"slots": Slot.get_enabled_slots(self.request.user)})
+        context.update({"version": version})
+
+        # Each slot gets its own presences, so the template does not have to
+        # scan all of them per slot
+        presences = {}
+        for presence in self.object_list:
+            presences.setdefault((presence.date, presence.pod), []).append(presence)
+        slots = Slot.get_enabled_slots(self.request.user)
+        for slot in slots:
+            slot["presences"] = presences.get((slot["date"], slot["pod"]), [])
+        context.update({"slots": slots})
         return context
 
     def get_queryset(self):
         slots = Slot.objects.filter(enabled=True)
         dates = [slot.date for slot in slots]
-        return Presence.objects.filter(date__in=dates).order_by("-user__is_superuser")
+        return (
+            Presence.objects.filter(date__in=dates)
+            .select_related("user", "user__userinfo")
+            .order_by("-is_tutor", "pk")
+        )
 
 
 class Calendar(BegeleiderRequiredMixin, LoginRequiredMixin, TemplateView):
@@ -217,13 +234,7 @@ class Calendar(BegeleiderRequiredMixin, LoginRequiredMixin, TemplateView):
         context = super().get_context_data()
 
         first_of_month = datetime.today().replace(day=1)
-        entries = self.request.user.presence_set.filter(
-            date__gte=first_of_month
-        ).order_by("date")
-
-        entry_fields = ["id", "date", "pod", "seen"]
-        entries = [model_to_dict(entry, entry_fields) for entry in entries]
-        context["entries"] = entries
+        context["entries"] = Presence.history(self.request.user, first_of_month)
 
         slots = Slot.objects.filter(enabled=True)
 
@@ -236,6 +247,36 @@ class Calendar(BegeleiderRequiredMixin, LoginRequiredMixin, TemplateView):
         return context
 
 
+class Export(BegeleiderRequiredMixin, LoginRequiredMixin, View):
+    """
+    Streams all presences between two dates as CSV or NDJSON, e.g.
+    /export/?from=2023-09-01&until=2024-07-31&format=ndjson
+    """
+
+    def get(self, request, *args, **kwargs):
+        try:
+            start = parse_date(request.GET.get("from", ""))
+            today = datetime.today().date().isoformat()
+            until = parse_date(request.GET.get("until", today))
+        except ValueError:
+            start = until = None
+        lines, content_type = FORMATS.get(
+            request.GET.get("format", "csv"), (None, None)
+        )
+        if start is None or until is None or lines is None:
+            return HttpResponseBadRequest("Invalid date range or format")
+
+        content = lines(presence_rows(start, until))
+        if isinstance(request, ASGIRequest):
+            content = stream_async(content)
+        response = StreamingHttpResponse(content, content_type=content_type)
+        extension = request.GET.get("format", "csv")
+        response["Content-Disposition"] = (
+            f'attachment; filename="presences-{start}-{until}.{extension}"'
+        )
+        return response
+
+
 class MarkAsSeen(BegeleiderRequiredMixin, View):
 
     def get(self, request, *args, **kwargs):
@@ -256,7 +297,8 @@ class RegisterManual(BegeleiderRequiredMixin, SlotContextMixin, CreateView):
     def form_valid(self, form):
         form.instance.date = self.slot.date
         form.instance.pod = self.slot.pod
-        return super().form_valid(form)
+        with transaction.atomic():
+            return super().form_valid(form)
 
     def post(self, request, *args, **kwargs):
 
@@ -266,7 +308,4 @@ class RegisterManual(BegeleiderRequiredMixin, SlotContextMixin, CreateView):
             # Already registered -> ignore
             response = HttpResponseRedirect(reverse("report"))
 
-        # Update pages on all clients
-        asyncio.run(sio.emit("update_report_page"))
-        asyncio.run(sio.emit("update_main_page"))
         return response
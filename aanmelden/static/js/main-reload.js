@@ -1,3 +1,56 @@
-const socket = io()
-socket.on('update_main_page', () => location.reload())
-window.addEventListener('beforeunload', () => socket.disconnect())
\ No newline at end of file
+const socket = io({auth: {page: 'main'}})
+const slotVersions = {}
+// Loaded with defer, the page is parsed already
+let version = Number(document.querySelector('[data-version]').dataset.version)
+
+const pluralize = (count, singular, plural) => count === 1 ? singular : plural
+
+function updateSlot(slot) {
+    const key = `${slot.name}-${slot.pod}`
+    if((slotVersions[key] ?? 0) > slot.version) return
+    slotVersions[key] = slot.version
+
+    const card = document.querySelector(`[data-slot="${key}"]`)
+    if(!card) return
+
+    const available = Number(slot.available)
+    card.querySelector('.slot-available').innerHTML = `
+        Er ${pluralize(available, 'is', 'zijn')}
+        <strong>${available < 1 ? 'geen' : available}</strong>
+        plek${pluralize(available, '', 'ken')} beschikbaar.`
+
+    const register = card.querySelector('.slot-register')
+    if(register) {
+        const full = available === 0
+        register.classList.toggle('btn-primary', !full)
+        register.classList.toggle('btn-outline-primary', full)
+        register.classList.toggle('disabled', full)
+        register.querySelector('iconify-icon').setAttribute('icon', full ? 'line-md:cancel' : 'line-md:login')
+    }
+
+    const tutors = card.querySelector('.slot-tutors')
+    if(slot.tutors.length) {
+        const title = document.createElement('strong')
+        title.textContent = 'Begeleiders:'
+        tutors.replaceChildren(title, ` ${slot.tutors.join(', ')}`)
+    } else {
+        const empty = document.createElement('span')
+        empty.className = 'text-muted'
+        empty.textContent = 'Er zijn (nog) geen begeleiders aanwezig.'
+        tutors.replaceChildren(empty)
+    }
+}
+
+// Changes made while we were not connected can't be patched in, fetch the page instead
+socket.on('connect', () => socket.emit('version', null, (current) => {
+    if(current > version) location.reload()
+}))
+
+socket.on('update_main_page', (delta) => {
+    if(!delta || delta.reload) return location.reload()
+
+    version = Math.max(version, delta.version)
+    delta.slots.forEach(updateSlot)
+})
+
+window.addEventListener('beforeunload', () => socket.disconnect())
@@ -1,19 +1,107 @@
-const socket = io()
-let skipReload = false
+const socket = io({auth: {page: 'report'}})
+const slotVersions = {}
+// Loaded with defer, the page is parsed already
+let version = Number(document.querySelector('[data-version]').dataset.version)
 
-socket.on('update_report_page', () => {
-    if(skipReload) {
-        skipReload = false
-        return
+const pluralize = (count, singular, plural) => count === 1 ? singular : plural
+
+function updateSlot(slot) {
+    const key = `${slot.name}-${slot.pod}`
+    if((slotVersions[key] ?? 0) > slot.version) return
+    slotVersions[key] = slot.version
+
+    const card = document.querySelector(`[data-slot="${key}"]`)
+    if(!card) return
+
+    const available = Number(slot.available)
+    const tutorCount = Number(slot.tutor_count)
+    const total = available + Number(slot.taken)
+    const badge = available === 0 ? 'text-bg-warning' : available < 0 ? 'text-bg-danger' : 'text-bg-primary'
+    card.querySelector('.slot-counts').innerHTML = `
+        <div>
+            Er ${pluralize(available, 'is', 'zijn')}
+            <span class="badge ${badge}">${Math.max(available, 0)} / ${total}</span>
+            slot${pluralize(available, '', 's')}
+            ${available < 0 ? `beschikbaar, <strong class="text-danger">${-available} te veel</strong>.` : 'beschikbaar.'}
+        </div>
+        <div>
+            Er ${pluralize(tutorCount, 'is', 'zijn')}
+            <span class="badge text-bg-primary">${tutorCount}</span>
+            begeleider${pluralize(tutorCount, '', 's')} aangemeld.
+        </div>`
+}
+
+function addPresence(presence) {
+    if(document.querySelector(`[data-presence="${presence.id}"]`)) return
+
+    const card = document.querySelector(`[data-date="${presence.date}"][data-pod="${presence.pod}"]`)
+    if(!card) return
+
+    const template = document.getElementById(presence.tutor ? 'tutor-template' : 'member-template')
+    const entry = template.content.firstElementChild.cloneNode(true)
+    entry.dataset.presence = presence.id
+    entry.querySelector('.presence-name').textContent = presence.name
+
+    const checkbox = entry.querySelector('input')
+    if(checkbox) {
+        checkbox.id = presence.id
+        checkbox.checked = presence.seen
+        checkbox.dataset.requestUrl = checkbox.dataset.requestUrl.replace('/0/', `/${presence.id}/`)
+        entry.querySelector('label').htmlFor = presence.id
+        entry.querySelector('.presence-mac').classList.toggle('d-none', !presence.seen || presence.seen_by !== 'mac')
+
+        const stripcard = entry.querySelector('.presence-stripcard')
+        if(presence.stripcard) {
+            stripcard.querySelector('.presence-stripcard-count').textContent =
+                `${presence.stripcard.used} / ${presence.stripcard.count}`
+        } else {
+            stripcard.remove()
+        }
     }
-    location.reload()
+
+    // Tutors are listed first
+    const list = card.querySelector('.slot-presences')
+    const firstMember = list.querySelector('[data-presence]:not([data-tutor])')
+    if(presence.tutor && firstMember) {
+        list.insertBefore(entry, firstMember)
+    } else {
+        list.appendChild(entry)
+    }
+}
+
+function updateSeen(presence) {
+    const entry = document.querySelector(`[data-presence="${presence.id}"]`)
+    if(!entry) return
+
+    const checkbox = entry.querySelector('input')
+    if(checkbox) checkbox.checked = presence.seen
+    const mac = entry.querySelector('.presence-mac')
+    if(mac) mac.classList.toggle('d-none', !presence.seen || presence.seen_by !== 'mac')
+}
+
+function removePresence(presence) {
+    document.querySelector(`[data-presence="${presence.id}"]`)?.remove()
+}
+
+// Changes made while we were not connected can't be patched in, fetch the page instead
+socket.on('connect', () => socket.emit('version', null, (current) => {
+    if(current > version) location.reload()
+}))
+
+socket.on('update_report_page', (delta) => {
+    if(!delta || delta.reload) return location.reload()
+
+    version = Math.max(version, delta.version)
+    delta.slots.forEach(updateSlot)
+    delta.added.forEach(addPresence)
+    delta.seen.forEach(updateSeen)
+    delta.removed.forEach(removePresence)
 })
 
 document.addEventListener('input', (event) => {
     let url = event.target.dataset.requestUrl
     if(!url) return
 
-    skipReload = true
     url = url.replace('::', event.target.checked)
     fetch(url)
 })
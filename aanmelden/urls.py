@@ -51,6 +51,7 @@ urlpatterns = [
     path("stripcard_full/", views.StripcardFull.as_view(), name="stripcard_full"),
     path("report/", views.Report.as_view(), name="report"),
     path("calendar/", views.Calendar.as_view(), name="calendar"),
+    path("export/", views.Export.as_view(), name="export"),
     path("logoff/", views.LogoffView.as_view(), name="logoff"),
     path("api/v2/free", api.FreeV2.as_view()),
     path("api/v1/mac_event", api.MacEvent.as_view()),
@@ -58,6 +59,7 @@ urlpatterns = [
         "api/v2/is_present/<str:day>/<str:pod>/<str:userid>", api.IsPresentV2.as_view()
     ),
     path("api/v2/are_present/<str:day>/<str:pod>", api.ArePresentV2.as_view()),
+    path("api/v2/presence_matrix", api.PresenceMatrix.as_view()),
     path(
         "api/v1/present_since_date/<str:userid>/<int:year>/<int:month>/<int:day>",
         api.PresentSinceDate.as_view(),
@@ -72,6 +74,9 @@ urlpatterns = [
         api.RegisterManual.as_view(),
     ),
     path("api/v1/future", api.FutureUpdate.as_view()),
+    path("api/v1/recurring", api.Recurring.as_view()),
+    path("api/v1/recurring/<int:pk>", api.Recurring.as_view()),
+    path("api/v1/metrics", api.Metrics.as_view()),
     path("api/v1/seen/<int:pk>/<str:seen>", api.MarkSeen.as_view()),
     re_path(r"oauth/.*", views.LoginResponseView.as_view()),
     path("", views.LoginView.as_view(), name="login"),
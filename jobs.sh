@@ -3,5 +3,9 @@
 while true; do
   echo "[$(date)] Cleaning old sessions."
   python3 manage.py clearsessions
+  echo "[$(date)] Expanding recurring registrations."
+  python3 manage.py expand_recurring
+  echo "[$(date)] Archiving old presences."
+  python3 manage.py archive_presences
   sleep 3600
 done
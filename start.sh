@@ -4,14 +4,38 @@
 python3 manage.py migrate                  # Apply database migrations
 python3 manage.py collectstatic --noinput  # Collect static files
 
+# Number of uvicorn processes, each on its own port behind nginx
+WORKERS=${WORKERS:-1}
+
+# Processes reach each other through Unix sockets in this directory
+export SOCKETIO_PEER_DIR=/tmp/aanmelden-sockets
+rm -rf "$SOCKETIO_PEER_DIR"
+
+rm -f /etc/nginx/upstream.conf
+i=0
+while [ $i -lt "$WORKERS" ]; do
+  echo "server 127.0.0.1:$((8000 + i));" >> /etc/nginx/upstream.conf
+  i=$((i + 1))
+done
+
 # Start nginx
 nginx
 
 # Start jobs in a loop
 sh /jobs.sh &
 
-# Start Gunicorn processes
-echo Starting uvicorn.
+# Start uvicorn processes, the first one in the foreground
+echo Starting $WORKERS uvicorn process\(es\).
+i=$((WORKERS - 1))
+while [ $i -gt 0 ]; do
+  uvicorn \
+    --host 0.0.0.0 \
+    --port $((8000 + i)) \
+    --log-level=info \
+    --access-log \
+    aanmelden.asgi:application &
+  i=$((i - 1))
+done
 exec uvicorn \
   --host 0.0.0.0 \
   --port 8000 \